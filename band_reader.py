@@ -0,0 +1,118 @@
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import rasterio
+from rasterio.enums import Resampling
+
+BANDS = {'rgb': ['B04', 'B03', 'B02'],
+         'all': ['B01', 'B02', 'B03', 'B04', 'B05', 'B06', 'B07', 'B08', 'B8A', 'B09', 'B11', 'B12']}
+
+
+def default_io_threads():
+    # band reads are I/O + decode bound and release the GIL, so oversubscribe the cores a little
+    return min(32, (os.cpu_count() or 1) + 4)
+
+
+def band_path(data_dir, patch, band):
+    return os.path.join(data_dir, patch, "{}_{}.tif".format(patch, band))
+
+
+class BandReader():
+    """ Reads GeoTIFF bands concurrently in a thread pool, reusing open rasterio handles from a bounded pool. """
+
+    def __init__(self, num_threads=None, max_open_handles=256):
+        self.num_threads = num_threads or default_io_threads()
+        self.max_open_handles = max_open_handles
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        # threads and open handles do not survive a fork (e.g. DataLoader workers), so each process starts its own
+        self._pid = os.getpid()
+        self._executor = ThreadPoolExecutor(max_workers=self.num_threads, thread_name_prefix="band-reader")
+        # idle handles per path, in least-recently-used order; a handle is only ever used by one thread at a time
+        self._idle = OrderedDict()
+        self._num_idle = 0
+
+    def __getstate__(self):
+        # threads, locks and open handles cannot be pickled (DataLoader workers started with spawn/forkserver);
+        # they are rebuilt lazily by read_patches, as after a fork
+        state = self.__dict__.copy()
+        for key in ['_lock', '_executor', '_idle', '_num_idle', '_pid']:
+            del state[key]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+        self._executor = None
+        self._idle = OrderedDict()
+        self._num_idle = 0
+        self._pid = None
+
+    def _checkout(self, path):
+        with self._lock:
+            handles = self._idle.get(path)
+            if handles:
+                self._num_idle -= 1
+                handle = handles.pop()
+                if not handles:
+                    del self._idle[path]
+                return handle
+        try:
+            return rasterio.open(path)
+        except rasterio.errors.RasterioIOError as e:
+            raise Exception("Could not open band file {}".format(path)) from e
+
+    def _release(self, path, handle):
+        evicted = []
+        with self._lock:
+            self._idle.setdefault(path, []).append(handle)
+            self._idle.move_to_end(path)
+            self._num_idle += 1
+            while self._num_idle > self.max_open_handles:
+                lru_path, handles = next(iter(self._idle.items()))
+                evicted.append(handles.pop())
+                self._num_idle -= 1
+                if not handles:
+                    del self._idle[lru_path]
+        for stale in evicted:
+            stale.close()
+
+    def read_band(self, path, out_size=None):
+        # out_size resamples bands stored at a coarser resolution (20m/60m) to out_size x out_size
+        handle = self._checkout(path)
+        try:
+            if out_size is not None and (handle.height, handle.width) != (out_size, out_size):
+                return handle.read(1, out_shape=(out_size, out_size), resampling=Resampling.bilinear)
+            return handle.read(1)
+        except Exception:
+            handle.close()
+            raise
+        finally:
+            if not handle.closed:
+                self._release(path, handle)
+
+    def read_patches(self, data_dir, patches, bands, out_size=None):
+        """ All `bands` of every patch in `patches`, read concurrently; returns a list of (W, H, C) arrays. """
+        if os.getpid() != self._pid:
+            self._lock = threading.Lock()
+            self._reset()
+        futures = [[self._executor.submit(self.read_band, band_path(data_dir, patch, band), out_size) for band in bands] for patch in patches]
+        return [np.stack([f.result() for f in patch_futures], axis=-1) for patch_futures in futures]
+
+    def read_patch(self, data_dir, patch, bands, out_size=None):
+        return self.read_patches(data_dir, [patch], bands, out_size=out_size)[0]
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+        with self._lock:
+            for handles in self._idle.values():
+                for handle in handles:
+                    handle.close()
+            self._idle = OrderedDict()
+            self._num_idle = 0
@@ -1,21 +1,80 @@
-from load_data_tf import BigEarthNetDataset
-import numpy as np
+import os
+import random
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 
+import numpy as np
 from tqdm import tqdm
 
+from band_reader import BandReader, BANDS
+from channel_stats import ChannelStats, OPTICAL_MAX_VALUE, CHANNEL_STATS_FILE, save_channel_stats
+from patch_manifest import PatchManifest
+from patch_store import PackedPatchStore, PATCH_SIZE
+
+_reader = None
+
+
+def _accumulate(stats, raw):
+    # statistics of the model inputs before normalization, i.e. clip(raw / max, 0, 1)
+    pixels = np.clip(raw.reshape(-1, raw.shape[-1]) / OPTICAL_MAX_VALUE, 0, 1)
+    stats.update(pixels)
+
+
+def tiff_chunk_stats(data_dir, bands, patches, io_threads=4):
+    global _reader
+    if _reader is None:
+        _reader = BandReader(num_threads=io_threads)
+    stats = ChannelStats(len(bands))
+    for raw in _reader.read_patches(data_dir, patches, bands, out_size=PATCH_SIZE):
+        _accumulate(stats, raw)
+    return stats
+
+
+def store_chunk_stats(store_dir, ids):
+    store = PackedPatchStore(store_dir)
+    stats = ChannelStats(len(store.bands))
+    for idx in ids:
+        _accumulate(stats, store[idx])
+    return stats
+
+
 if __name__ == '__main__':
-    dataset = BigEarthNetDataset("../SmallEarthNet")
-    print("Calculating channel means and standard deviation:")
-    sums = np.zeros(3)
-    sum_sqs = np.zeros(3)
-    for i in tqdm(range(len(dataset))):
-        img, _ = dataset[i]
-        w, h, _ = img.shape
-        sums += img.sum(axis=(0, 1))
-        sum_sqs += np.square(img).sum(axis=(0, 1))
-    n = len(dataset) * w * h
-    means = sums / n
-    print(sums, sum_sqs)
-    stds = np.sqrt(n * sum_sqs - np.square(sums)) / n
-    print(means, stds)
+    psr = ArgumentParser()
+    psr.add_argument("--data-root", type=str, default="../cs330-storage", help="Path to all data")
+    psr.add_argument("--data-subdir", type=str, default="SmallEarthNet", help="Directory of patches, relative to --data-root")
+    psr.add_argument("--mode", choices=['rgb', 'all'], default='rgb', help="Which spectral bands to compute statistics for")
+    psr.add_argument("--packed-dir", type=str, default=None, help="Read pixels from a packed patch store built by pack_data.py (its bands override --mode)")
+    psr.add_argument("--sample-fraction", type=float, default=1., help="Fraction of patches to sample for a quick estimate")
+    psr.add_argument("--seed", type=int, default=42, help="Seed for --sample-fraction")
+    psr.add_argument("--num-workers", type=int, default=None, help="Worker processes (default: number of cores)")
+    psr.add_argument("--chunk-size", type=int, default=256, help="Patches per work item")
+    psr.add_argument("--label-cache-dir", type=str, default='.', help="Where the patch manifest is cached")
+    psr.add_argument("--output", type=str, default=CHANNEL_STATS_FILE, help="Statistics file read by utils.normalize")
+    args = psr.parse_args()
+
+    if args.packed_dir is not None:
+        store = PackedPatchStore(args.packed_dir)
+        bands, num_patches = store.bands, len(store)
+        work = partial(store_chunk_stats, args.packed_dir)
+    else:
+        data_dir = os.path.join(args.data_root, args.data_subdir)
+        filter_files = [os.path.join(args.data_root, 'patches_with_cloud_and_shadow.csv'), os.path.join(args.data_root, 'patches_with_seasonal_snow.csv')]
+        patches = PatchManifest.load(data_dir, filter_files=filter_files, cache_dir=args.label_cache_dir).patches
+        bands, num_patches = BANDS[args.mode], len(patches)
+        work = partial(tiff_chunk_stats, data_dir, bands)
+    ids = list(range(num_patches))
+    if args.sample_fraction < 1.:
+        ids = sorted(random.Random(args.seed).sample(ids, max(1, int(args.sample_fraction * num_patches))))
+    items = [ids[i:i + args.chunk_size] for i in range(0, len(ids), args.chunk_size)]
+    if args.packed_dir is None:
+        items = [[patches[i] for i in chunk] for chunk in items]
 
+    print("Calculating channel means and standard deviations of bands {} over {} patches:".format(bands, len(ids)))
+    stats = ChannelStats(len(bands))
+    with ProcessPoolExecutor(max_workers=args.num_workers) as executor:
+        for chunk_stats in tqdm(executor.map(work, items), total=len(items)):
+            stats.merge(chunk_stats)
+    print(stats.mean, stats.std)
+    save_channel_stats(stats, bands, len(ids), path=args.output)
+    print("Saved to", args.output)
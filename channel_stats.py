@@ -0,0 +1,63 @@
+import os
+import json
+
+import numpy as np
+
+# Magic number some guys at Google figured out. Don't touch.
+OPTICAL_MAX_VALUE = 2000.
+# written by `python calculate_mean.py`, read by utils.channel_stats
+CHANNEL_STATS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'channel_stats.json')
+
+
+class ChannelStats():
+    """ Per-channel count, mean and sum of squared deviations, mergeable with Chan et al.'s parallel update. """
+
+    def __init__(self, n_channels):
+        self.count = 0
+        self.mean = np.zeros(n_channels)
+        self.m2 = np.zeros(n_channels)
+
+    def update(self, pixels):
+        # pixels: (n_pixels, n_channels)
+        batch = ChannelStats(pixels.shape[1])
+        batch.count = len(pixels)
+        batch.mean = pixels.mean(axis=0, dtype=np.float64)
+        batch.m2 = np.square(pixels - batch.mean).sum(axis=0)
+        self.merge(batch)
+
+    def merge(self, other):
+        if other.count == 0:
+            return self
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean = self.mean + delta * (other.count / count)
+        self.m2 = self.m2 + other.m2 + np.square(delta) * (self.count * other.count / count)
+        self.count = count
+        return self
+
+    @property
+    def std(self):
+        return np.sqrt(self.m2 / self.count)
+
+
+def load_channel_stats(path=CHANNEL_STATS_FILE):
+    # {band list: {'means': [...], 'stds': [...], ...}}, empty if no statistics have been computed yet
+    if not os.path.isfile(path):
+        return {}
+    with open(path, 'r') as f:
+        entries = json.load(f)
+    return {tuple(entry['bands']): entry for entry in entries.values()}
+
+
+def save_channel_stats(stats, bands, num_patches, path=CHANNEL_STATS_FILE, max_value=OPTICAL_MAX_VALUE):
+    # entries for other band sets already in the file are kept
+    entries = {}
+    if os.path.isfile(path):
+        with open(path, 'r') as f:
+            entries = json.load(f)
+    entries[",".join(bands)] = {'bands': list(bands), 'max_value': max_value, 'num_patches': num_patches, 'num_pixels': int(stats.count),
+                                'means': stats.mean.tolist(), 'stds': stats.std.tolist()}
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(entries, f, indent=2)
+    os.replace(tmp_path, path)
@@ -0,0 +1,151 @@
+import os
+import json
+import struct
+import threading
+import zlib
+
+import numpy as np
+from tqdm import tqdm
+
+from label_index import label_cache_key
+
+# Bump whenever the on-disk layout below changes.
+EPISODE_SHARD_VERSION = 1
+
+_INDEX_FILE = 'index.json'
+# every record is its compressed length followed by zlib(images | labels | raw_labels)
+_RECORD_HEADER = struct.Struct('<I')
+
+
+def _shard_name(i):
+    return "episodes-{:05d}.shard".format(i)
+
+
+def write_episode_shards(meta_dataset, out_dir, num_episodes, split='train', mode='greedy', episodes_per_shard=1024, compression_level=6, chunk_size=64):
+    """ Pre-render `num_episodes` tasks of `split` as sampled by meta_dataset.sample_batch, into shard files of
+    `episodes_per_shard` tasks each.
+
+    Images are stored as raw uint16 reflectances and decoded by the reader, so one set of shards serves any
+    normalization and data format.
+    """
+    if num_episodes < 1:
+        raise Exception("Number of episodes must be strictly positive.")
+    split = meta_dataset.canonical_split(split)
+    dataset = meta_dataset.dataset
+    os.makedirs(out_dir, exist_ok=True)
+    shards = []
+    f = None
+    written = 0
+    with tqdm(total=num_episodes) as progress:
+        while written < num_episodes:
+            ids, labels, raw_labels = meta_dataset.sample_batch_indices(batch_size=min(chunk_size, num_episodes - written), split=split, mode=mode)
+            raw = np.stack(dataset.read_raw_many(ids.ravel().tolist())).astype(np.uint16, copy=False)
+            raw = raw.reshape(ids.shape + raw.shape[1:])
+            for i in range(len(ids)):
+                if written % episodes_per_shard == 0:
+                    if f is not None:
+                        f.close()
+                    shards.append({'file': _shard_name(len(shards)), 'num_episodes': 0})
+                    f = open(os.path.join(out_dir, shards[-1]['file']), 'wb')
+                record = zlib.compress(raw[i].tobytes() + labels[i].astype(np.float32).tobytes() + raw_labels[i].astype(np.int16).tobytes(), compression_level)
+                f.write(_RECORD_HEADER.pack(len(record)))
+                f.write(record)
+                shards[-1]['num_episodes'] += 1
+                written += 1
+            progress.update(len(ids))
+    if f is not None:
+        f.close()
+    # the index is written last so that an interrupted run is never picked up as a valid set of shards
+    index = {'version': EPISODE_SHARD_VERSION, 'patches_key': label_cache_key(dataset.patches), 'split': split, 'mode': mode,
+             'bands': list(dataset.bands), 'image_shape': list(raw.shape[2:]), 'support_size': meta_dataset.support_size,
+             'label_subset_size': meta_dataset.label_subset_size, 'num_episodes': written, 'shards': shards}
+    with open(os.path.join(out_dir, _INDEX_FILE + '.tmp'), 'w') as f:
+        json.dump(index, f, indent=2)
+    os.replace(os.path.join(out_dir, _INDEX_FILE + '.tmp'), os.path.join(out_dir, _INDEX_FILE))
+    return index
+
+
+class EpisodeShardReader():
+    """ Endless stream of episodes written by write_episode_shards, read front to back in large blocks.
+
+    Shards are visited in a fresh random order on every pass and their records are decorrelated by a shuffle buffer
+    of compressed episodes. Stands in for the meta-dataset of an EpisodePrefetcher: sample_batch fills the same
+    (images, labels, raw_labels) buffers as MetaBigEarthNetTaskDataset.sample_batch. Shard files are divided over
+    the dataset's (rank, world_size).
+    """
+
+    def __init__(self, shard_dir, meta_dataset, split='train', shuffle_buffer=256, seed=None, block_size=8 << 20):
+        index_path = os.path.join(shard_dir, _INDEX_FILE)
+        if not os.path.isfile(index_path):
+            raise Exception("No episode shards found at {}; write them with `python make_episode_shards.py`.".format(shard_dir))
+        with open(index_path, 'r') as f:
+            index = json.load(f)
+        if index['version'] != EPISODE_SHARD_VERSION:
+            raise Exception("Episode shards at {} have version {} but version {} is required; please regenerate them.".format(shard_dir, index['version'], EPISODE_SHARD_VERSION))
+        dataset = meta_dataset.dataset
+        if index['patches_key'] != label_cache_key(dataset.patches):
+            raise Exception("Episode shards at {} were generated for a different patch listing.".format(shard_dir))
+        if index['bands'] != list(dataset.bands):
+            raise Exception("Episode shards at {} hold bands {}, but the dataset uses {}.".format(shard_dir, index['bands'], dataset.bands))
+        if index['support_size'] != meta_dataset.support_size or index['label_subset_size'] != meta_dataset.label_subset_size:
+            raise Exception("Episode shards at {} hold tasks of support size {} and label subset size {}, but the dataset uses {} and {}.".format(
+                shard_dir, index['support_size'], index['label_subset_size'], meta_dataset.support_size, meta_dataset.label_subset_size))
+        if index['split'] != meta_dataset.canonical_split(split):
+            raise Exception("Episode shards at {} hold {} tasks, not {} tasks.".format(shard_dir, index['split'], split))
+        self.meta_dataset = meta_dataset
+        self.dataset = dataset
+        self.index = index
+        self.shard_paths = [os.path.join(shard_dir, shard['file']) for shard in index['shards']][meta_dataset.rank::meta_dataset.world_size]
+        if not self.shard_paths:
+            raise Exception("Episode shards at {} hold {} shard(s), too few for rank {} of {}.".format(shard_dir, len(index['shards']), meta_dataset.rank, meta_dataset.world_size))
+        self.shuffle_buffer = max(1, shuffle_buffer)
+        self.block_size = block_size
+        self.image_shape = (meta_dataset.support_size,) + tuple(index['image_shape'])
+        self.label_shape = (meta_dataset.support_size, meta_dataset.label_subset_size)
+        seed = meta_dataset.sampling_seed if seed is None else seed
+        self._rng = np.random.default_rng([seed, meta_dataset.rank])
+        self._records = self._read_records()
+        self._buffer = []
+        self._lock = threading.Lock()
+
+    def _read_records(self):
+        while True:
+            for i in self._rng.permutation(len(self.shard_paths)):
+                with open(self.shard_paths[i], 'rb', buffering=self.block_size) as f:
+                    if hasattr(os, 'posix_fadvise'):
+                        os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+                    while True:
+                        header = f.read(_RECORD_HEADER.size)
+                        if not header:
+                            break
+                        yield f.read(_RECORD_HEADER.unpack(header)[0])
+
+    def next_record(self):
+        # a random slot of the shuffle buffer is handed out and refilled with the next record on disk
+        with self._lock:
+            while len(self._buffer) < self.shuffle_buffer:
+                self._buffer.append(next(self._records))
+            i = int(self._rng.integers(len(self._buffer)))
+            record, self._buffer[i] = self._buffer[i], next(self._records)
+        return record
+
+    def decode_record(self, record, out):
+        images, labels, raw_labels = out
+        data = zlib.decompress(record)
+        n_pixels, n_labels = int(np.prod(self.image_shape)), int(np.prod(self.label_shape))
+        raw = np.frombuffer(data, dtype=np.uint16, count=n_pixels).reshape(self.image_shape)
+        labels[...] = np.frombuffer(data, dtype=np.float32, count=n_labels, offset=2 * n_pixels).reshape(self.label_shape)
+        raw_labels[...] = np.frombuffer(data, dtype=np.int16, count=n_labels, offset=2 * n_pixels + 4 * n_labels).reshape(self.label_shape)
+        for j in range(len(raw)):
+            self.dataset.decode_raw(raw[j], out=images[j])
+
+    def batch_ring(self, batch_size=8, size=2):
+        return self.meta_dataset.batch_ring(batch_size, size=size)
+
+    def sample_batch(self, batch_size=8, split='train', mode=None, out=None):
+        # split and mode are fixed when the shards are written; decompression and decoding run outside the lock
+        if out is None:
+            _, out = self.batch_ring(batch_size, size=1).acquire()
+        for i in range(batch_size):
+            self.decode_record(self.next_record(), tuple(buffer[i] for buffer in out))
+        return out
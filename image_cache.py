@@ -0,0 +1,53 @@
+import threading
+from collections import OrderedDict
+
+
+class ImageCache():
+    """ Thread-safe LRU cache of decoded images, bounded by a total byte budget. """
+
+    def __init__(self, max_bytes):
+        if max_bytes <= 0:
+            raise Exception("Image cache budget must be strictly positive.")
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits, self.misses, self.evictions = 0, 0, 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            img = self._entries.get(key)
+            if img is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return img
+
+    def put(self, key, img):
+        if img.nbytes > self.max_bytes:
+            return
+        # cached arrays are shared between callers, so they must never be written to
+        img.setflags(write=False)
+        with self._lock:
+            if key in self._entries:
+                return
+            self._entries[key] = img
+            self.nbytes += img.nbytes
+            while self.nbytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+                self.evictions += 1
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'entries': len(self._entries),
+                    'nbytes': self.nbytes, 'hit_rate': self.hits / lookups if lookups else 0.}
+
+    def __str__(self):
+        stats = self.stats()
+        return "{entries} images / {mb:.1f}MB, hits/misses/evictions: {hits}/{misses}/{evictions} (hit rate {hit_rate:.3f})".format(mb=stats['nbytes'] / 2**20, **stats)
@@ -0,0 +1,205 @@
+import os
+import json
+import hashlib
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import numpy as np
+
+from patch_manifest import PatchList, listing_key
+
+# Bump whenever the label cache layout or the scan below changes; old caches are then ignored.
+LABEL_CACHE_VERSION = 1
+# Bump whenever the split cache layout or the assignment rule in assign_splits changes.
+SPLIT_CACHE_VERSION = 1
+SPLITS = ('train', 'val', 'test')
+
+
+def _read_label_chunk(data_dir, patches):
+    chunk_labels = []
+    for patch in patches:
+        with open(os.path.join(data_dir, patch, "{}_labels_metadata.json".format(patch)), 'r') as f:
+            chunk_labels.append(json.load(f)['labels'])
+    return chunk_labels
+
+
+def scan_labels(data_dir, patches, num_workers=None, chunk_size=2048):
+    # parse every label metadata file in a process pool; label columns are ordered by first appearance
+    chunks = [patches[i:i + chunk_size] for i in range(0, len(patches), chunk_size)]
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        patch_labels = [labels for chunk in executor.map(partial(_read_label_chunk, data_dir), chunks) for labels in chunk]
+    label_to_idx = {}
+    for labels in patch_labels:
+        for label in labels:
+            label_to_idx.setdefault(label, len(label_to_idx))
+    label_matrix = np.zeros((len(patches), len(label_to_idx)), dtype=bool)
+    for i, labels in enumerate(patch_labels):
+        label_matrix[i, [label_to_idx[label] for label in labels]] = True
+    return list(label_to_idx.keys()), label_matrix
+
+
+def label_cache_key(patches, filter_files=()):
+    h = hashlib.sha1("label-cache-v{}".format(LABEL_CACHE_VERSION).encode())
+    # a PatchList carries the hash of its listing stored in the patch manifest, so the listing is not re-hashed here
+    h.update((patches.key if isinstance(patches, PatchList) else listing_key(patches)).encode())
+    for file_path in filter_files:
+        with open(file_path, 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()[:16]
+
+
+class LabelTable():
+    """ Per-patch labels of a patch listing: names, a (N, n_classes) k-hot matrix and per-class counts. """
+
+    def __init__(self, patches, label_names, label_matrix):
+        self.patches = patches
+        self.label_names = list(label_names)
+        self.label_matrix = label_matrix
+        self.counts = Counter(dict(zip(self.label_names, label_matrix.sum(axis=0).tolist())))
+
+    @classmethod
+    def load(cls, data_dir, patches, filter_files=(), cache_dir='.', num_workers=None):
+        cache_path = os.path.join(cache_dir, "labels_{}.npz".format(label_cache_key(patches, filter_files)))
+        if os.path.isfile(cache_path):
+            with np.load(cache_path) as cache:
+                if int(cache['version']) == LABEL_CACHE_VERSION:
+                    n_classes = len(cache['label_names'])
+                    label_matrix = np.unpackbits(cache['label_bits'], axis=1, count=n_classes).astype(bool)
+                    return cls(patches, cache['label_names'].tolist(), label_matrix)
+        print("Label cache at {} not found; scanning label metadata.".format(cache_path))
+        label_names, label_matrix = scan_labels(data_dir, patches, num_workers=num_workers)
+        table = cls(patches, label_names, label_matrix)
+        table.save(cache_path)
+        return table
+
+    def save(self, cache_path):
+        os.makedirs(os.path.dirname(cache_path) or '.', exist_ok=True)
+        tmp_path = cache_path + '.tmp.npz'
+        np.savez(tmp_path, version=LABEL_CACHE_VERSION, patches=np.array(self.patches), label_names=np.array(self.label_names),
+                 label_bits=np.packbits(self.label_matrix, axis=1), counts=self.label_matrix.sum(axis=0))
+        os.replace(tmp_path, cache_path)
+
+
+def assign_splits(label_matrix, class_splits):
+    """ Patch indices (int32) of each split, given the split (0/1/2 = train/val/test, -1 = none) of every label column.
+
+    A patch goes to the split holding most of its labels; ties go to train, then val.
+    """
+    class_splits = np.asarray(class_splits)
+    onehot = np.zeros((len(class_splits), len(SPLITS)), dtype=np.int32)
+    assigned = np.flatnonzero(class_splits >= 0)
+    onehot[assigned, class_splits[assigned]] = 1
+    cardinality = np.asarray(label_matrix, dtype=np.int32) @ onehot
+    assignment = np.argmax(cardinality, axis=1)
+    return tuple(np.flatnonzero(assignment == s).astype(np.int32) for s in range(len(SPLITS)))
+
+
+def split_cache_key(patches, filter_files, split_keys, seed, val_prop, test_prop):
+    h = hashlib.sha1("split-cache-v{}".format(SPLIT_CACHE_VERSION).encode())
+    h.update(label_cache_key(patches, filter_files).encode())
+    h.update(json.dumps({'keys': [sorted(keys) for keys in split_keys], 'seed': seed, 'val_prop': val_prop, 'test_prop': test_prop}).encode())
+    return h.hexdigest()[:16]
+
+
+class SplitTable():
+    """ Train/val/test patch indices of a label table, for a given assignment of label names to splits. """
+
+    def __init__(self, indices, keys):
+        self.train_indices, self.val_indices, self.test_indices = indices
+        self.train_keys, self.val_keys, self.test_keys = keys
+
+    @property
+    def indices(self):
+        return self.train_indices, self.val_indices, self.test_indices
+
+    @classmethod
+    def load(cls, label_table, split_keys, filter_files=(), seed=42, val_prop=0.25, test_prop=0.2, cache_dir='.', rebuild=False):
+        # the cache file is keyed on everything the split depends on, so a stale split can never be picked up
+        split_keys = tuple(set(keys) for keys in split_keys)
+        key = split_cache_key(label_table.patches, filter_files, split_keys, seed, val_prop, test_prop)
+        cache_path = os.path.join(cache_dir, "splits_{}.npz".format(key))
+        if os.path.isfile(cache_path) and not rebuild:
+            with np.load(cache_path) as cache:
+                if int(cache['version']) == SPLIT_CACHE_VERSION:
+                    return cls(tuple(cache[split] for split in SPLITS), split_keys)
+        print("Building new train-val-test split and saving to", cache_path)
+        class_splits = np.full(len(label_table.label_names), -1)
+        for s, keys in enumerate(split_keys):
+            class_splits[[i for i, name in enumerate(label_table.label_names) if name in keys]] = s
+        table = cls(assign_splits(label_table.label_matrix, class_splits), split_keys)
+        table.save(cache_path)
+        return table
+
+    def save(self, cache_path):
+        os.makedirs(os.path.dirname(cache_path) or '.', exist_ok=True)
+        tmp_path = cache_path + '.tmp.npz'
+        np.savez(tmp_path, version=SPLIT_CACHE_VERSION, train=self.train_indices, val=self.val_indices, test=self.test_indices,
+                 train_keys=np.array(sorted(self.train_keys)), val_keys=np.array(sorted(self.val_keys)), test_keys=np.array(sorted(self.test_keys)))
+        os.replace(tmp_path, cache_path)
+
+
+def label_bitcodes(label_matrix):
+    # (N, n_classes) k-hot matrix -> (N,) uint64 codes with bit i set iff class i is present
+    label_matrix = np.asarray(label_matrix)
+    if label_matrix.shape[1] > 64:
+        raise Exception("Label bitcodes only support up to 64 classes, but found {}.".format(label_matrix.shape[1]))
+    shifts = np.arange(label_matrix.shape[1], dtype=np.uint64)
+    return (label_matrix.astype(np.uint64) << shifts).sum(axis=1, dtype=np.uint64)
+
+
+def popcount(codes):
+    # number of set bits of every uint64 code
+    codes = np.ascontiguousarray(codes, dtype=np.uint64)
+    return np.unpackbits(codes.view(np.uint8).reshape(-1, 8), axis=1).sum(axis=1)
+
+
+class LabelCombinationIndex():
+    """ Groups patch ids by their exact label bitcode, so label-combination cells reduce to arithmetic over the distinct codes. """
+
+    def __init__(self, codes, ids=None):
+        codes = np.asarray(codes, dtype=np.uint64)
+        ids = np.arange(len(codes)) if ids is None else np.asarray(ids, dtype=np.int64)
+        codes = codes[ids]
+        order = np.argsort(codes, kind='stable')
+        self.ids = ids[order]
+        self.codes, self.offsets, self.sizes = np.unique(codes[order], return_index=True, return_counts=True)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def cell_ids(self, classes):
+        # cell of every distinct code w.r.t. `classes`; classes[0] is the most significant bit, as in format(cell, '0nb')
+        n = len(classes)
+        cells = np.zeros(len(self.codes), dtype=np.int64)
+        for j, c in enumerate(classes):
+            cells |= ((self.codes >> np.uint64(c)) & np.uint64(1)).astype(np.int64) << (n - 1 - j)
+        return cells
+
+    def partition(self, classes):
+        return CellPartition(self, self.cell_ids(classes), 1 << len(classes))
+
+
+class CellPartition():
+    """ The patches of a LabelCombinationIndex split into the 2^n inclusion patterns of a class subset. """
+
+    def __init__(self, index, cells, n_cells):
+        self.index = index
+        self.order = np.argsort(cells, kind='stable')
+        self.bounds = np.concatenate([[0], np.cumsum(index.sizes[self.order])])
+        sorted_cells = cells[self.order]
+        self.lo = self.bounds[np.searchsorted(sorted_cells, np.arange(n_cells), 'left')]
+        self.hi = self.bounds[np.searchsorted(sorted_cells, np.arange(n_cells), 'right')]
+
+    def sizes(self):
+        return self.hi - self.lo
+
+    def size(self, cell):
+        return int(self.hi[cell] - self.lo[cell])
+
+    def draw(self, cell, r):
+        # r-th patch (0 <= r < size(cell)) of the cell
+        pos = self.lo[cell] + r
+        k = np.searchsorted(self.bounds, pos, 'right') - 1
+        group = self.order[k]
+        return int(self.index.ids[self.index.offsets[group] + pos - self.bounds[k]])
@@ -1,102 +1,77 @@
 import os
 import random
 
-import csv
-import gdal
-import rasterio
-import pickle
-import json
-
-from tqdm import tqdm
 import warnings
 
-from collections import Counter
-
 import numpy as np
 import torch
-from torch.utils.data import Dataset, IterableDataset, DataLoader
+from torch.utils.data import Dataset, IterableDataset, DataLoader, get_worker_info
 
+from patch_manifest import PatchManifest
+from label_index import SPLITS, LabelTable, SplitTable
+from band_reader import BandReader, BANDS
+from channel_stats import OPTICAL_MAX_VALUE
+from patch_store import PATCH_SIZE
 
-_OPTICAL_MAX_VALUE = 2000. # Magic number some guys at Google figured out. Don't touch.
+
+_OPTICAL_MAX_VALUE = OPTICAL_MAX_VALUE
 
 
 class BigEarthNetDataset(Dataset):
-    def __init__(self, data_dir="../BigEarthNet-v1.0/", filter_files=["../patches_with_cloud_and_shadow.csv", "../patches_with_seasonal_snow.csv"], filter_data=True, mode='rgb', label_count_cache='./label_counts.pkl', val_prop=0.25, test_prop=0.2, split_file=None, split_save_path='splits.pkl', seed=42, meta=False):
+    def __init__(self, data_dir="../BigEarthNet-v1.0/", filter_files=["../patches_with_cloud_and_shadow.csv", "../patches_with_seasonal_snow.csv"], filter_data=True, mode='rgb', label_cache_dir='.', val_prop=0.25, test_prop=0.2, split_file=None, split_save_path='splits.pkl', seed=42, meta=False, io_threads=None):
         super(BigEarthNetDataset, self).__init__()
-        random.seed(42)
         mode = mode.lower()
         if mode not in ['rgb', 'all']:
             raise Exception("Dataset mode must be 'rgb' (using only RGB channels) or 'all' (use all spectral bands.")
         self.mode = mode
-        if self.mode == 'rgb':
-            self.bands = ['B04', 'B03', 'B02']
-        else:
-            self.bands = ['B01', 'B02', 'B03', 'B04', 'B05',
-                                  'B06', 'B07', 'B08', 'B8A', 'B09', 'B11', 'B12']
+        self.bands = list(BANDS[self.mode])
         self.data_dir = data_dir
-        self.patches = os.listdir(data_dir)
-        self.patches.sort()
-
-        elimination_patch_list = []
         if filter_data:
             for file_path in filter_files:
                 if not os.path.exists(file_path):
                     print('ERROR: file located at', file_path, 'does not exist')
                     exit()
-                with open(file_path, 'r') as f:
-                    csv_reader = csv.reader(f, delimiter=',')
-                    for row in csv_reader:
-                        elimination_patch_list.append(row[0])
-            elimination_patch_list = set(elimination_patch_list)
-            self.patches = [patch for patch in self.patches if patch not in elimination_patch_list]
-
-        self.counts = Counter()
-        if not os.path.isfile(label_count_cache):
-            print("Label count cache at {} not found; rebuilding cache.".format(label_count_cache))
-            for patch in tqdm(self.patches):
-                with open(os.path.join(data_dir, patch, "{}_labels_metadata.json".format(patch)), 'r') as f:
-                    metadata = json.load(f)
-                    self.counts.update(metadata['labels'])
-            with open(label_count_cache, 'wb') as cache_file:
-                pickle.dump(self.counts, cache_file)
-        else:
-            with open(label_count_cache, 'rb') as cache_file:
-                self.counts = pickle.load(cache_file)
+        # sorted, filtered listing, persisted and revalidated by directory mtime instead of listed on every start
+        self.patch_manifest = PatchManifest.load(data_dir, filter_files=filter_files if filter_data else [], cache_dir=label_cache_dir)
+        self.patches = self.patch_manifest.patches
+
+        label_table = LabelTable.load(data_dir, self.patches, filter_files=filter_files if filter_data else [], cache_dir=label_cache_dir)
+        self.label_table = label_table
+        self.filter_files = filter_files if filter_data else []
+        self.label_matrix = label_table.label_matrix
+        self.label_names = label_table.label_names
+        self.counts = label_table.counts
         self.idx_to_label = dict(enumerate(sorted(self.counts.keys())))
         #self.label_to_idx = {v: k for k, v in self.idx_to_label.items()}
         self.meta = meta # are we using this as a part of meta-training/val/test?
+        # concurrent GeoTIFF band reads over a bounded pool of open handles
+        self.band_reader = BandReader(num_threads=io_threads)
 
     def peek_label(self, idx):
-        patch = self.patches[idx]
-        with open(os.path.join(self.data_dir, patch, "{}_labels_metadata.json".format(patch)), 'r') as f:
-            metadata = json.load(f)
-            raw_labels = set(metadata['labels'])
-            return raw_labels
+        return {self.label_names[i] for i in np.where(self.label_matrix[idx])[0]}
+
+    @property
+    def image_shape(self):
+        return (len(self.bands), PATCH_SIZE, PATCH_SIZE)
+
+    def get_images(self, ids, out=None):
+        # bands of all patches are read concurrently and normalized straight into `out`, shape (len(ids), C, W, H)
+        if out is None:
+            out = torch.empty((len(ids),) + self.image_shape)
+        # 20m and 60m bands are upsampled to the 10m grid
+        band_stacks = self.band_reader.read_patches(self.data_dir, [self.patches[idx] for idx in ids], self.bands, out_size=PATCH_SIZE)
+        for i, band_stack in enumerate(band_stacks):
+            img = out[i].numpy()
+            np.divide(np.moveaxis(band_stack, -1, 0), _OPTICAL_MAX_VALUE, out=img, casting='unsafe') # (C, W, H)
+            np.clip(img, 0, 1, out=img)
+        return out
 
     def __getitem__(self, idx):
         # load image
-        band_stack = []
-        patch = self.patches[idx]
-        for bands in self.bands:
-            band_path = os.path.join(self.data_dir, patch, "{}_{}.tif".format(patch, bands))
-            assert os.path.isfile(band_path)
-            band_ds = gdal.Open(band_path,  gdal.GA_ReadOnly)
-            raster_band = band_ds.GetRasterBand(1)
-            band_data = raster_band.ReadAsArray()
-            band_stack.append(band_data)
-        if self.mode == 'rgb':
-            img = np.stack(band_stack) / _OPTICAL_MAX_VALUE # (C, W, H)
-            img = np.clip(img, 0, 1)
-            img = torch.Tensor(img)
-        else:
-            raise NotImplementedError()
-
-        with open(os.path.join(self.data_dir, patch, "{}_labels_metadata.json".format(patch)), 'r') as f:
-            metadata = json.load(f)
-            raw_labels = set(metadata['labels'])
+        img = self.get_images([idx])[0]
 
         # k-hot vector of classes -> sample batches by taking 
-        labels = np.array([1 if cover_type in raw_labels else 0 for cover_type in self.counts.keys()])
+        labels = self.label_matrix[idx].astype(int)
         if not self.meta:
             labels = torch.LongTensor(labels)
         return img, labels
@@ -115,13 +90,15 @@ class BigEarthNetDataset(Dataset):
 
 
 class MetaBigEarthNetTaskDataset(IterableDataset):
-    def __init__(self, split='train', support_size=8, label_subset_size=3, data_dir="../BigEarthNet-v1.0/", filter_files=["../patches_with_cloud_and_shadow.csv", "../patches_with_seasonal_snow.csv"], filter_data=True, mode='rgb', label_count_cache='./label_counts.pkl', val_prop=0.25, test_prop=0.2, split_file=None, split_save_path='splits.pkl', seed=42):
+    def __init__(self, split='train', support_size=8, label_subset_size=3, data_dir="../BigEarthNet-v1.0/", filter_files=["../patches_with_cloud_and_shadow.csv", "../patches_with_seasonal_snow.csv"], filter_data=True, mode='rgb', label_cache_dir='.', val_prop=0.25, test_prop=0.2, split_file=None, split_save_path=None, seed=42, io_threads=None, sampling_seed=None):
         super(MetaBigEarthNetTaskDataset, self).__init__()
-        random.seed(seed)
+        # class splits come from their own generator; episodes are drawn per task in __iter__, see episode_rng
+        key_rng = random.Random(seed)
+        self.sampling_seed = seed if sampling_seed is None else sampling_seed
         self.support_size = support_size
         self.label_subset_size = label_subset_size
         self.split = split
-        self.dataset = BigEarthNetDataset(data_dir=data_dir, filter_files=filter_files, filter_data=filter_data, mode=mode, label_count_cache=label_count_cache, val_prop=val_prop, test_prop=test_prop, split_file=split_file, split_save_path=split_save_path, seed=seed, meta=True)
+        self.dataset = BigEarthNetDataset(data_dir=data_dir, filter_files=filter_files, filter_data=filter_data, mode=mode, label_cache_dir=label_cache_dir, val_prop=val_prop, test_prop=test_prop, split_file=split_file, split_save_path=split_save_path, seed=seed, meta=True, io_threads=io_threads)
         if split not in ['train', 'val', 'test']:
             raise Exception("Invalid split; must be one of 'train', 'val', or 'test'.")
         if support_size < 2:
@@ -130,11 +107,13 @@ class MetaBigEarthNetTaskDataset(IterableDataset):
             raise Exception("Subset size must be strictly positive.")
 
         self.counts = self.dataset.counts 
-        test_keys = set(sorted(random.choices(list(self.counts.keys()), k=int(test_prop * len(self.counts)))))
-        remaining_keys = [k for k in self.counts.keys() if k not in test_keys]
-        validation_keys = set(sorted(random.choices(remaining_keys, k=int(val_prop * len(remaining_keys)))))
-        train_keys = {k for k in remaining_keys if k not in validation_keys}
-        indices = self.get_train_val_test_indices(premade_split_file=split_file, split_save_path=split_save_path)
+        self.test_keys = set(sorted(key_rng.choices(list(self.counts.keys()), k=int(test_prop * len(self.counts)))))
+        remaining_keys = [k for k in self.counts.keys() if k not in self.test_keys]
+        self.validation_keys = set(sorted(key_rng.choices(remaining_keys, k=int(val_prop * len(remaining_keys)))))
+        self.train_keys = {k for k in remaining_keys if k not in self.validation_keys}
+        if split_file is not None or split_save_path is not None:
+            warnings.warn("split_file and split_save_path are ignored; splits are cached under label_cache_dir, keyed on the data listing, filters, seed and proportions.")
+        indices = self.get_train_val_test_indices(cache_dir=label_cache_dir, seed=seed, val_prop=val_prop, test_prop=test_prop)
         self.split = split
         if split == 'train':
             self.indices = indices[0]
@@ -146,89 +125,89 @@ class MetaBigEarthNetTaskDataset(IterableDataset):
             self.indices = indices[2]
             self.keys = self.train_keys
         self.key_indices = [i for i, k in enumerate(self.counts.keys()) if k in self.keys]
+        # tasks drawn so far by this copy of the dataset (one per worker); kept across __iter__ calls so that a new
+        # epoch or iterator continues the episode stream instead of replaying it
+        self._next_task = 0
+
+    @staticmethod
+    def canonical_split(split):
+        # anything but 'train' and 'val' samples from the test split, as in load_data_tf
+        return split if split in ['train', 'val'] else 'test'
+
+    def episode_rng(self, task):
+        # DataLoader workers each run their own copy of __iter__: worker w of n owns the tasks w, w + n, ... of the
+        # split, and task t always draws from the same isolated stream, so workers never duplicate each other's episodes.
+        # Workers started afresh (non-persistent workers, every epoch) get a new copy of the dataset with the task
+        # count reset, so their base seed, drawn by the DataLoader from torch's generator per iterator, is mixed in
+        worker = get_worker_info()
+        worker_id, num_workers, base_seed = (0, 1, 0) if worker is None else (worker.id, worker.num_workers, worker.seed - worker.id)
+        return np.random.default_rng([self.sampling_seed, SPLITS.index(self.canonical_split(self.split)), base_seed, worker_id + num_workers * task])
 
     def __iter__(self):
         n_classes = len(self.key_indices)
         #key_mask = np.array([1 if i in self.key_indices else 0 for i in range(len(self.counts))])
         while True:
+            rng = self.episode_rng(self._next_task)
+            self._next_task += 1
             seen = np.zeros((n_classes,), dtype=int)
-            support = [] # target shape: (support, w, h) -> then we can collate
+            ids = [] # target shape: (support,)
             labels = [] # target shape: (support, label_subset_size)
             raw_labels = [] # target shape: (support,) [list of objects]
-            while len(support) < self.support_size:
-                idx = random.choice(self.indices)
-                img, label = self.dataset[idx] # shape: (w, h), (n_classes)
+            while len(ids) < self.support_size:
+                idx = self.indices[rng.integers(len(self.indices))]
+                # labels are checked before any pixels are read, so rejected patches cost no I/O
+                label = self.dataset.label_matrix[idx].astype(int) # shape: (n_classes)
                 raw_indices = np.intersect1d(np.where(label)[0], self.key_indices) 
                 label = label[self.key_indices] 
                 if np.count_nonzero(label | seen) > self.label_subset_size:
                     continue
                 seen = label | seen
-                support.append(img)
+                ids.append(idx)
                 labels.append(torch.LongTensor(label))
                 curr_label_indices = torch.LongTensor(np.pad(raw_indices, (0, self.label_subset_size - len(raw_indices)), 'constant', constant_values=-1))
                 raw_labels.append(curr_label_indices)
-            support = torch.stack(support, dim=0)
+            support = torch.empty((self.support_size,) + self.dataset.image_shape) # shape: (support, c, w, h)
+            self.dataset.get_images(ids, out=support)
             labels = torch.stack(labels, dim=0) # shape is temporariliy (support, n_classes)
             raw_labels = torch.stack(raw_labels, dim=0)
             selected_class_mask = torch.abs(labels).sum(dim=0) > 0
             cardinality = np.count_nonzero(seen)
-            artificial_classes = np.random.choice(np.where(~selected_class_mask)[0], size=self.label_subset_size - cardinality, replace=False)
+            artificial_classes = rng.choice(np.where(~selected_class_mask)[0], size=self.label_subset_size - cardinality, replace=False)
             selected_class_mask[artificial_classes] = True
             labels = labels[:, selected_class_mask]
             yield support, labels, raw_labels
 
 
-    def get_train_val_test_indices(self, premade_split_file=None, split_save_path=None, rebuild=False):
+    def get_train_val_test_indices(self, cache_dir='.', seed=42, val_prop=0.25, test_prop=0.2, rebuild=False):
         if hasattr(self, 'train_indices') and hasattr(self, 'val_indices') and hasattr(self, 'test_indices') and not rebuild:
             return self.train_indices, self.val_indices, self.test_indices
-        train_indices, val_indices, test_indices = [], [], []
-        if premade_split_file and not rebuild:
-            print("Reloading train-val-test split cache from", premade_split_file)
-            try:
-                with open(premade_split_file, 'rb') as f:
-                    indices = pickle.load(f)
-                    self.train_keys, self.validation_keys, self.test_keys = indices['train_keys'], indices['val_keys'], indices['test_keys']
-                    return indices['train'], indices['val'], indices['test']
-            except OSError:
-                message = ("Creating new split instead with file name {}".format(split_save_path), "Attempting to create split with this file name.")[split_save_path is None]
-                print("File", premade_split_file, "not found. {}".format(message))
-                if split_save_path is None:
-                    split_save_path = premade_split_file
-        if split_save_path is None: 
-            warnings.warn("Building index list, but not saving!")
-        print("Building new train-val-test split and saving to", split_save_path)
-        #self.labels = []
-        for i, patch in enumerate(tqdm(self.patches)):
-            with open(os.path.join(self.data_dir, patch, "{}_labels_metadata.json".format(patch)), 'r') as f:
-                metadata = json.load(f)
-                labels = set(metadata['labels'])
-                train_cardinality = len(labels & self.train_keys)
-                val_cardinality = len(labels & self.validation_keys)
-                test_cardinality = len(labels & self.test_keys)
-                max_cardinality = max(train_cardinality, val_cardinality, test_cardinality)
-                if max_cardinality == train_cardinality:
-                    train_indices.append(i)
-                elif max_cardinality == val_cardinality:
-                    val_indices.append(i)
-                else:
-                    test_indices.append(i)
-                #self.labels.append(labels)
-        if split_save_path:
-            index_dict = {'train_keys': self.train_keys,
-                    'val_keys': self.validation_keys,
-                    'test_keys': self.test_keys,
-                    'train': train_indices,
-                    'val': val_indices,
-                    'test': test_indices}
-            with open(split_save_path, 'wb') as f:
-                pickle.dump(index_dict, f)
-        return train_indices, val_indices, test_indices
-
-def get_dataloaders(train_batch_size=8, val_batch_size=8, test_batch_size=8, support_size=8, label_subset_size=3, data_dir="../BigEarthNet-v1.0/", filter_files=["../patches_with_cloud_and_shadow.csv", "../patches_with_seasonal_snow.csv"], filter_data=True, mode='rgb', label_count_cache='./label_counts.pkl', val_prop=0.25, test_prop=0.2, split_file=None, split_save_path='splits.pkl', seed=42):
-    train = MetaBigEarthNetTaskDataset(split='train', support_size=support_size, label_subset_size=label_subset_size, data_dir=data_dir, filter_files=filter_files, filter_data=filter_data, mode=mode, label_count_cache=label_count_cache, val_prop=val_prop, test_prop=test_prop, split_file=split_file, split_save_path=split_save_path, seed=seed)
-    val = MetaBigEarthNetTaskDataset(split='val', support_size=support_size, label_subset_size=label_subset_size, data_dir=data_dir, filter_files=filter_files, filter_data=filter_data, mode=mode, label_count_cache=label_count_cache, val_prop=val_prop, test_prop=test_prop, split_file=split_file, split_save_path=split_save_path, seed=seed)
-    test = MetaBigEarthNetTaskDataset(split='test', support_size=support_size, label_subset_size=label_subset_size, data_dir=data_dir, filter_files=filter_files, filter_data=filter_data, mode=mode, label_count_cache=label_count_cache, val_prop=val_prop, test_prop=test_prop, split_file=split_file, split_save_path=split_save_path, seed=seed)
-    train_dataloader = DataLoader(train, batch_size=train_batch_size)
-    val_dataloader = DataLoader(val, batch_size=val_batch_size)
-    test_dataloader = DataLoader(test, batch_size=test_batch_size)
+        splits = SplitTable.load(self.dataset.label_table, (self.train_keys, self.validation_keys, self.test_keys), filter_files=self.dataset.filter_files,
+                                 seed=seed, val_prop=val_prop, test_prop=test_prop, cache_dir=cache_dir, rebuild=rebuild)
+        return splits.indices
+
+def seed_worker(worker_id):
+    # DataLoader seeds torch per worker; forward that seed to the other global generators so that any library code
+    # drawing from them in a worker does not repeat its siblings. Episode sampling itself uses episode_rng.
+    worker_seed = torch.initial_seed() % 2 ** 32
+    np.random.seed(worker_seed)
+    random.seed(worker_seed)
+
+
+def make_dataloader(dataset, batch_size, num_workers=0, pin_memory=None, prefetch_factor=2):
+    kwargs = {}
+    if num_workers > 0:
+        # workers (and the BandReader they re-create after the fork) live for the whole run instead of per epoch
+        kwargs = dict(worker_init_fn=seed_worker, persistent_workers=True, prefetch_factor=prefetch_factor)
+    if pin_memory is None:
+        pin_memory = torch.cuda.is_available()
+    return DataLoader(dataset, batch_size=batch_size, num_workers=num_workers, pin_memory=pin_memory, **kwargs)
+
+
+def get_dataloaders(train_batch_size=8, val_batch_size=8, test_batch_size=8, support_size=8, label_subset_size=3, data_dir="../BigEarthNet-v1.0/", filter_files=["../patches_with_cloud_and_shadow.csv", "../patches_with_seasonal_snow.csv"], filter_data=True, mode='rgb', label_cache_dir='.', val_prop=0.25, test_prop=0.2, split_file=None, split_save_path=None, seed=42, io_threads=None, num_workers=0, pin_memory=None, prefetch_factor=2, sampling_seed=None):
+    train = MetaBigEarthNetTaskDataset(split='train', support_size=support_size, label_subset_size=label_subset_size, data_dir=data_dir, filter_files=filter_files, filter_data=filter_data, mode=mode, label_cache_dir=label_cache_dir, val_prop=val_prop, test_prop=test_prop, split_file=split_file, split_save_path=split_save_path, seed=seed, io_threads=io_threads, sampling_seed=sampling_seed)
+    val = MetaBigEarthNetTaskDataset(split='val', support_size=support_size, label_subset_size=label_subset_size, data_dir=data_dir, filter_files=filter_files, filter_data=filter_data, mode=mode, label_cache_dir=label_cache_dir, val_prop=val_prop, test_prop=test_prop, split_file=split_file, split_save_path=split_save_path, seed=seed, io_threads=io_threads, sampling_seed=sampling_seed)
+    test = MetaBigEarthNetTaskDataset(split='test', support_size=support_size, label_subset_size=label_subset_size, data_dir=data_dir, filter_files=filter_files, filter_data=filter_data, mode=mode, label_cache_dir=label_cache_dir, val_prop=val_prop, test_prop=test_prop, split_file=split_file, split_save_path=split_save_path, seed=seed, io_threads=io_threads, sampling_seed=sampling_seed)
+    train_dataloader = make_dataloader(train, train_batch_size, num_workers=num_workers, pin_memory=pin_memory, prefetch_factor=prefetch_factor)
+    val_dataloader = make_dataloader(val, val_batch_size, num_workers=num_workers, pin_memory=pin_memory, prefetch_factor=prefetch_factor)
+    test_dataloader = make_dataloader(test, test_batch_size, num_workers=num_workers, pin_memory=pin_memory, prefetch_factor=prefetch_factor)
     return train_dataloader, val_dataloader, test_dataloader
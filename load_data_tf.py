@@ -1,117 +1,135 @@
 import os
 import random
+import threading
 
-import csv
-import gdal
-import rasterio
-import pickle
-import json
-
-from tqdm import tqdm
 import warnings
 
-from collections import Counter
-
 import numpy as np
-from utils import normalize
-from functools import reduce
+import tensorflow as tf
+from utils import normalize, normalize_raw, convert_to_powerset_tf, convert_to_bin_rel, OPTICAL_MAX_VALUE
+from patch_store import PackedPatchStore, PATCH_SIZE
+from image_cache import ImageCache
+from band_reader import BandReader, BANDS
+from patch_manifest import PatchManifest
+from label_index import SPLITS, LabelTable, SplitTable, LabelCombinationIndex, label_bitcodes, label_cache_key, popcount
 from itertools import cycle
-from collections import defaultdict
-import operator as op
+from collections import defaultdict, deque
 
 
-# Magic number some guys at Google figured out. Don't touch.
-_OPTICAL_MAX_VALUE = 2000.
+_OPTICAL_MAX_VALUE = OPTICAL_MAX_VALUE
+# Bump whenever the episode manifest layout changes.
+MANIFEST_VERSION = 1
 
 
 class BigEarthNetDataset():
-    def __init__(self, data_dir="../BigEarthNet-v1.0/", filter_files=["../patches_with_cloud_and_shadow.csv", "../patches_with_seasonal_snow.csv"], filter_data=True, mode='rgb', label_count_cache='./label_counts.pkl', val_prop=0.25, test_prop=0.2, split_file=None, split_save_path='splits.pkl', seed=42, meta=False, data_format='channels_last'):
-        random.seed(42)
+    def __init__(self, data_dir="../BigEarthNet-v1.0/", filter_files=["../patches_with_cloud_and_shadow.csv", "../patches_with_seasonal_snow.csv"], filter_data=True, mode='rgb', label_cache_dir='.', val_prop=0.25, test_prop=0.2, split_file=None, split_save_path='splits.pkl', seed=42, meta=False, data_format='channels_last', packed_dir=None, image_cache_bytes=0, io_threads=None, raw_pixels=False, warn_resampling=True):
         mode = mode.lower()
         if mode not in ['rgb', 'all']:
             raise Exception(
                 "Dataset mode must be 'rgb' (using only RGB channels) or 'all' (use all spectral bands.")
         self.mode = mode
-        if self.mode == 'rgb':
-            self.bands = ['B04', 'B03', 'B02']
-        else:
-            self.bands = ['B01', 'B02', 'B03', 'B04', 'B05',
-                          'B06', 'B07', 'B08', 'B8A', 'B09', 'B11', 'B12']
+        self.bands = list(BANDS[self.mode])
         self.data_dir = data_dir
         self.data_format = data_format
-        self.patches = os.listdir(data_dir)
-        self.patches.sort()
-
-        elimination_patch_list = []
+        # raw_pixels keeps uint16 reflectances up to the model, which normalizes them in-graph (utils.prepare_images)
+        if raw_pixels and data_format != 'channels_last':
+            raise Exception("Raw uint16 pixels are only supported with data_format='channels_last'.")
+        self.raw_pixels = raw_pixels
+        self.pixel_dtype = np.uint16 if raw_pixels else np.float32
         if filter_data:
             for file_path in filter_files:
                 if not os.path.exists(file_path):
-                    print('ERROR: file located at',
-                          file_path, 'does not exist')
+                    print('ERROR: file located at', file_path, 'does not exist')
                     exit()
-                with open(file_path, 'r') as f:
-                    csv_reader = csv.reader(f, delimiter=',')
-                    for row in csv_reader:
-                        elimination_patch_list.append(row[0])
-            elimination_patch_list = set(elimination_patch_list)
-            self.patches = [
-                patch for patch in self.patches if patch not in elimination_patch_list]
-
-        self.counts = Counter()
-        if not os.path.isfile(label_count_cache):
-            print("Label count cache at {} not found; rebuilding cache.".format(
-                label_count_cache))
-            for patch in tqdm(self.patches):
-                with open(os.path.join(data_dir, patch, "{}_labels_metadata.json".format(patch)), 'r') as f:
-                    metadata = json.load(f)
-                    self.counts.update(metadata['labels'])
-            with open(label_count_cache, 'wb') as cache_file:
-                pickle.dump(self.counts, cache_file)
-        else:
-            with open(label_count_cache, 'rb') as cache_file:
-                self.counts = pickle.load(cache_file)
+        # sorted, filtered listing, persisted and revalidated by directory mtime instead of listed on every start
+        self.patch_manifest = PatchManifest.load(data_dir, filter_files=filter_files if filter_data else [], cache_dir=label_cache_dir)
+        self.patches = self.patch_manifest.patches
+
+        label_table = LabelTable.load(data_dir, self.patches, filter_files=filter_files if filter_data else [], cache_dir=label_cache_dir)
+        self.label_table = label_table
+        self.filter_files = filter_files if filter_data else []
+        self.label_matrix = label_table.label_matrix
+        self.label_names = label_table.label_names
+        self.counts = label_table.counts
         self.idx_to_label = dict(enumerate(sorted(self.counts.keys())))
         #self.label_to_idx = {v: k for k, v in self.idx_to_label.items()}
         self.meta = meta  # are we using this as a part of meta-training/val/test?
 
+        self.store = None
+        self.band_reader = None
+        if packed_dir is not None:
+            self.store = PackedPatchStore(packed_dir)
+            self.store.check_compatible(self.patches, self.bands, list(self.counts.keys()))
+        else:
+            # concurrent GeoTIFF band reads over a bounded pool of open handles
+            self.band_reader = BandReader(num_threads=io_threads)
+            # pack_data.py reads every patch exactly once to remove this cost, so it turns the warning off
+            if self.mode == 'all' and warn_resampling:
+                warnings.warn("Resampling 20m/60m bands on every read; pack them once with `python pack_data.py --mode all` and pass packed_dir.")
+        # opt-in LRU cache of normalized images, bounded by image_cache_bytes
+        self.image_cache = ImageCache(image_cache_bytes) if image_cache_bytes > 0 else None
+
     def peek_label(self, idx):
-        patch = self.patches[idx]
-        with open(os.path.join(self.data_dir, patch, "{}_labels_metadata.json".format(patch)), 'r') as f:
-            metadata = json.load(f)
-            raw_labels = set(metadata['labels'])
-            return raw_labels
+        return {self.label_names[i] for i in np.where(self.label_matrix[idx])[0]}
 
-    def __getitem__(self, idx):
-        # load image
-        band_stack = []
-        patch = self.patches[idx]
-        for bands in self.bands:
-            band_path = os.path.join(
-                self.data_dir, patch, "{}_{}.tif".format(patch, bands))
-            assert os.path.isfile(band_path)
-            band_ds = gdal.Open(band_path,  gdal.GA_ReadOnly)
-            raster_band = band_ds.GetRasterBand(1)
-            band_data = raster_band.ReadAsArray()
-            band_stack.append(band_data)
-        if self.mode == 'rgb':
-            img = np.stack(band_stack) / _OPTICAL_MAX_VALUE  # (C, W, H)
-            img = np.clip(img, 0, 1)
-            if self.data_format == 'channels_last':
-                img = np.transpose(img, (1, 2, 0))
-        else:
-            raise NotImplementedError()
+    def read_raw(self, idx):
+        # raw uint16 reflectances, shape (W, H, C)
+        return self.read_raw_many([idx])[0]
 
-        with open(os.path.join(self.data_dir, patch, "{}_labels_metadata.json".format(patch)), 'r') as f:
-            metadata = json.load(f)
-            raw_labels = set(metadata['labels'])
+    def read_raw_many(self, ids):
+        # all bands of all patches in `ids` are read concurrently
+        if self.store is not None:
+            return [self.store[idx] for idx in ids]
+        # 20m and 60m bands are upsampled to the 10m grid; a packed store does this once, offline
+        return self.band_reader.read_patches(self.data_dir, [self.patches[idx] for idx in ids], self.bands, out_size=PATCH_SIZE)
 
+    def read_labels(self, idx):
         # k-hot vector of classes -> sample batches by taking
-        labels = np.array(
-            [1 if cover_type in raw_labels else 0 for cover_type in self.counts.keys()])
+        return self.label_matrix[idx].astype(int)
+
+    def decode(self, idx):
+        return self.decode_raw(self.read_raw(idx))
+
+    def decode_raw(self, raw, out=None):
+        # decodes straight into `out` (e.g. a slot of a BatchRing buffer) when given
+        if self.raw_pixels:
+            if out is None:
+                return np.asarray(raw, dtype=np.uint16)
+            out[...] = raw
+            return out
+        if self.data_format == 'channels_first':
+            raw = np.transpose(raw, (2, 0, 1))
+        if out is None:
+            out = np.empty(raw.shape, dtype=np.float32)
+        img = np.divide(raw, np.float32(_OPTICAL_MAX_VALUE), out=out, casting='unsafe')  # (W, H, C)
+        np.clip(img, 0, 1, out=img)
+        return normalize(img, data_format=self.data_format, out=img, bands=self.bands)
+
+    def get_images(self, ids, out=None):
+        # decoded images for `ids`; cache misses are read together in one concurrent batch.
+        # with `out` (an array of len(ids) images) they are written straight into it and `out` is returned.
+        # cached images are shared and read-only
+        images = [self.image_cache.get(idx) if self.image_cache is not None else None for idx in ids]
+        missing = [i for i, img in enumerate(images) if img is None]
+        if out is not None:
+            for i, img in enumerate(images):
+                if img is not None:
+                    out[i] = img
+        if missing:
+            for i, raw in zip(missing, self.read_raw_many([ids[i] for i in missing])):
+                images[i] = self.decode_raw(raw, out=out[i] if out is not None else None)
+                if self.image_cache is not None:
+                    # buffers handed in through `out` get overwritten, so the cache keeps its own copy
+                    self.image_cache.put(ids[i], images[i].copy() if out is not None else images[i])
+        return images if out is None else out
+
+    def __getitem__(self, idx):
+        # load image
+        img = self.get_images([idx])[0]
+        labels = self.read_labels(idx)
         # if not self.meta:
         #    labels = torch.LongTensor(labels)
-        img = normalize(img, data_format=self.data_format)
-        return img.astype(np.float32), labels
+        return img, labels
 
     def __len__(self):
         return len(self.patches)
@@ -130,15 +148,51 @@ class BigEarthNetDataset():
         return names
 
 
+class BatchRing():
+    """ Preallocated (images, labels, raw_labels) meta-batch buffers, kept on a free list.
+
+    acquire() takes a free buffer, waiting for one if none is free, and release(slot) puts it back once its batch
+    has been consumed, so a buffer is never handed out again while it is still being filled or read.
+    """
+
+    def __init__(self, size, batch_size, support_size, image_shape, label_subset_size, pixel_dtype=np.float32):
+        self.size = size
+        self.images = np.zeros((size, batch_size, support_size, *image_shape), dtype=pixel_dtype)
+        self.labels = np.zeros((size, batch_size, support_size, label_subset_size), dtype=np.float32)
+        self.raw_labels = np.zeros((size, batch_size, support_size, label_subset_size))
+        self._free = deque(range(size))
+        self._available = threading.Condition()
+
+    def acquire(self, timeout=None):
+        # (slot, (images, labels, raw_labels)), or None if no buffer was released within `timeout` seconds
+        with self._available:
+            if not self._available.wait_for(lambda: self._free, timeout=timeout):
+                return None
+            slot = self._free.popleft()
+        return slot, (self.images[slot], self.labels[slot], self.raw_labels[slot])
+
+    def release(self, slot):
+        with self._available:
+            self._free.append(slot)
+            self._available.notify()
+
+
 class MetaBigEarthNetTaskDataset():
-    def __init__(self, support_size=8, label_subset_size=3, data_dir="../BigEarthNet-v1.0/", filter_files=["../patches_with_cloud_and_shadow.csv", "../patches_with_seasonal_snow.csv"], filter_data=True, mode='rgb', label_count_cache='./label_counts.pkl', val_prop=0.25, test_prop=0.2, split_file=None, split_save_path='splits.pkl', seed=42, data_format='channels_last'):
+    def __init__(self, support_size=8, label_subset_size=3, data_dir="../BigEarthNet-v1.0/", filter_files=["../patches_with_cloud_and_shadow.csv", "../patches_with_seasonal_snow.csv"], filter_data=True, mode='rgb', label_cache_dir='.', val_prop=0.25, test_prop=0.2, split_file=None, split_save_path=None, seed=42, data_format='channels_last', packed_dir=None, image_cache_bytes=0, io_threads=None, raw_pixels=False, rank=0, world_size=1, sampling_seed=None):
         super(MetaBigEarthNetTaskDataset, self).__init__()
-        random.seed(seed)
+        if not 0 <= rank < world_size:
+            raise Exception("Shard rank must be in [0, world_size), but got rank {} of {}.".format(rank, world_size))
+        # isolated generator for the split keys; global `random` and `np.random` are never touched
+        key_rng = random.Random(seed)
+        # episodes are sharded over (rank, world_size); see episode_rng
+        self.rank = rank
+        self.world_size = world_size
+        self.sampling_seed = seed if sampling_seed is None else sampling_seed
         self.support_size = support_size
         self.label_subset_size = label_subset_size
         self.data_dir = data_dir
-        self.dataset = BigEarthNetDataset(data_dir=data_dir, filter_files=filter_files, filter_data=filter_data, mode=mode, label_count_cache=label_count_cache,
-                                          val_prop=val_prop, test_prop=test_prop, split_file=split_file, split_save_path=split_save_path, seed=seed, meta=True, data_format=data_format)
+        self.dataset = BigEarthNetDataset(data_dir=data_dir, filter_files=filter_files, filter_data=filter_data, mode=mode, label_cache_dir=label_cache_dir,
+                                          val_prop=val_prop, test_prop=test_prop, split_file=split_file, split_save_path=split_save_path, seed=seed, meta=True, data_format=data_format, packed_dir=packed_dir, image_cache_bytes=image_cache_bytes, io_threads=io_threads, raw_pixels=raw_pixels)
 
         if support_size < 2:
             raise Exception("Support set size must be at least 2.")
@@ -146,161 +200,324 @@ class MetaBigEarthNetTaskDataset():
             raise Exception("Subset size must be strictly positive.")
 
         self.counts = self.dataset.counts
-        self.test_keys = set(sorted(random.choices(
+        self.test_keys = set(sorted(key_rng.choices(
             list(self.counts.keys()), k=int(test_prop * len(self.counts)))))
         remaining_keys = [
             k for k in self.counts.keys() if k not in self.test_keys]
-        self.val_keys = set(sorted(random.choices(
+        self.val_keys = set(sorted(key_rng.choices(
             remaining_keys, k=int(val_prop * len(remaining_keys)))))
         self.train_keys = {k for k in remaining_keys if k not in self.val_keys}
-        self.train_indices, self.val_indices, self.test_indices = self.get_train_val_test_indices(premade_split_file=split_file, split_save_path=split_save_path)
-        self.label_indices_dict = defaultdict(set)
-        for i, (_, lbl) in enumerate(tqdm(self.dataset, leave=False)):
-            for class_id in np.where(lbl)[0]:
-                self.label_indices_dict[class_id].add(i)
+        if split_file is not None or split_save_path is not None:
+            warnings.warn("split_file and split_save_path are ignored; splits are cached under label_cache_dir, keyed on the data listing, filters, seed and proportions.")
+        self.train_indices, self.val_indices, self.test_indices = self.get_train_val_test_indices(cache_dir=label_cache_dir, seed=seed, val_prop=val_prop, test_prop=test_prop)
+        # built from the cached label matrix only -- no pixel data is touched at startup
+        label_matrix = self.dataset.label_matrix
+        # patch ids grouped by exact label combination, for permutation-mode sampling
+        self.label_codes = label_bitcodes(label_matrix)
+        self.label_combination_index = LabelCombinationIndex(self.label_codes)
+        # the same grouping restricted to each split, for balanced-mode sampling
+        self.split_pools = {split: LabelCombinationIndex(self.label_codes, ids=self.get_split(split)[0]) for split in ['train', 'val', 'test']}
+        # per-split label codes over the split's own classes, and greedy-sampling [drawn, accepted] counters
+        self._split_codes = {}
+        self._rejection_counts = defaultdict(lambda: [0, 0])
+        self._stats_lock = threading.Lock()
+        # number of tasks this shard has sampled per split
+        self._task_counts = defaultdict(int)
+        # pre-generated tasks replayed by mode='manifest', per split
+        self.manifests = {}
+
+    @staticmethod
+    def canonical_split(split):
+        # anything but 'train' and 'val' samples from the test split
+        return split if split in ['train', 'val'] else 'test'
+
+    def reserve_tasks(self, split, num_tasks=1):
+        # the first of `num_tasks` consecutive local task numbers of this shard's split, taken in one go so that a
+        # meta-batch always holds the same tasks, however prefetch workers interleave
+        split = self.canonical_split(split)
+        with self._stats_lock:
+            first = self._task_counts[split]
+            self._task_counts[split] += num_tasks
+        return first
 
-    def sample_batch(self, batch_size=8, split='train', mode='greedy'):
+    def episode_rng(self, split, local_task=None):
+        # isolated generator for a task of this shard (the next one if local_task is None): rank r owns the global
+        # task numbers r, r + world_size, ... of each split, and task t always draws from the same stream, so shards
+        # are disjoint and reproducible
+        split = self.canonical_split(split)
+        if local_task is None:
+            local_task = self.reserve_tasks(split)
+        return np.random.default_rng([self.sampling_seed, SPLITS.index(split), self.rank + self.world_size * local_task])
+
+    def get_split(self, split):
         if split == 'train':
-            indices = self.train_indices
-            keys = self.train_keys
+            return self.train_indices, self.train_keys
         elif split == 'val':
-            indices = self.val_indices
-            keys = self.val_keys
+            return self.val_indices, self.val_keys
         else:
-            indices = self.test_indices
-            keys = self.test_keys
+            return self.test_indices, self.test_keys
 
-        # target shape: (batch_size, support, w, h) -> then we can collate
-        batch_support = np.zeros((batch_size, self.support_size, *self.dataset.get_shape()))
-        # target shape: (batch_size, support, label_subset_size)
-        batch_labels = np.zeros((batch_size, self.support_size, self.label_subset_size))
-        # target shape: (batch_size, support, label_subset_size) [-1 end-padded labels]
-        batch_raw_labels = np.zeros((batch_size, self.support_size, self.label_subset_size))
+    def sample_batch_indices(self, batch_size=8, split='train', mode='greedy', return_classes=False, out=None):
+        # like sample_batch, but returns patch ids of shape (batch_size, support) instead of decoded images;
+        # return_classes also returns the (batch_size, label_subset_size) class ids behind each task's label columns.
+        # out=(labels, raw_labels) fills preallocated buffers instead of allocating new ones
+        split = self.canonical_split(split)
+        if mode == 'manifest':
+            batch = self.replay_manifest(batch_size=batch_size, split=split, return_classes=return_classes)
+            if out is not None:
+                out[0][...], out[1][...] = batch[1], batch[2]
+                batch = (batch[0],) + tuple(out) + batch[3:]
+            return batch
+        indices, keys = self.get_split(split)
+        key_indices = np.array([i for i, k in enumerate(self.counts.keys()) if k in keys], dtype=int)
+
+        batch_ids = np.zeros((batch_size, self.support_size), dtype=np.int64)
+        if out is None:
+            # target shape: (batch_size, support, label_subset_size)
+            batch_labels = np.zeros((batch_size, self.support_size, self.label_subset_size), dtype=np.float32)
+            # target shape: (batch_size, support, label_subset_size) [-1 end-padded labels]
+            batch_raw_labels = np.zeros((batch_size, self.support_size, self.label_subset_size))
+        else:
+            batch_labels, batch_raw_labels = out
+        batch_classes = np.zeros((batch_size, self.label_subset_size), dtype=np.int64)
+        first_task = self.reserve_tasks(split, batch_size)
         for i in range(batch_size):
-            seen, support, temp_support_labels, raw_labels = self.gather_support(keys, indices, mode=mode)
+            rng = self.episode_rng(split, first_task + i)
+            seen, support_ids, temp_support_labels, raw_labels = self.select_support(keys, indices, mode=mode, split=split, rng=rng)
 
             selected_class_mask = np.abs(temp_support_labels).sum(axis=0) > 0
             cardinality = np.count_nonzero(seen)
             if cardinality < self.label_subset_size: 
-                artificial_classes = np.random.choice(np.where(~selected_class_mask)[0], size=self.label_subset_size - cardinality, replace=False)
+                artificial_classes = rng.choice(np.where(~selected_class_mask)[0], size=self.label_subset_size - cardinality, replace=False)
                 selected_class_mask[artificial_classes] = True
             batch_labels[i, ...] = temp_support_labels[:, selected_class_mask]
-            batch_support[i, ...] = support
+            batch_ids[i, ...] = support_ids
             batch_raw_labels[i, ...] = raw_labels
-        return batch_support.astype(np.float32), batch_labels.astype(np.float32), batch_raw_labels
+            batch_classes[i, ...] = key_indices[selected_class_mask]
+        if return_classes:
+            return batch_ids, batch_labels, batch_raw_labels, batch_classes
+        return batch_ids, batch_labels, batch_raw_labels
+
+    def write_episode_manifest(self, path, num_tasks, split='test', mode='greedy'):
+        # materializes `num_tasks` tasks (patch ids, subset labels, raw labels, class ids) for replay with mode='manifest'
+        split = self.canonical_split(split)
+        ids, labels, raw_labels, classes = self.sample_batch_indices(batch_size=num_tasks, split=split, mode=mode, return_classes=True)
+        np.savez(path, version=MANIFEST_VERSION, patches_key=label_cache_key(self.dataset.patches), split=split, mode=mode,
+                 support_size=self.support_size, label_subset_size=self.label_subset_size,
+                 ids=ids, labels=labels, raw_labels=raw_labels, classes=classes)
+
+    def load_episode_manifest(self, path, split=None):
+        with np.load(path) as manifest:
+            manifest = dict(manifest)
+        if int(manifest['version']) != MANIFEST_VERSION:
+            raise Exception("Episode manifest {} has version {} but version {} is required; please regenerate it.".format(path, int(manifest['version']), MANIFEST_VERSION))
+        if str(manifest['patches_key']) != label_cache_key(self.dataset.patches):
+            raise Exception("Episode manifest {} was generated for a different patch listing.".format(path))
+        if int(manifest['support_size']) != self.support_size or int(manifest['label_subset_size']) != self.label_subset_size:
+            raise Exception("Episode manifest {} holds tasks of support size {} and label subset size {}, but the dataset uses {} and {}.".format(
+                path, int(manifest['support_size']), int(manifest['label_subset_size']), self.support_size, self.label_subset_size))
+        if split is not None and self.canonical_split(split) != str(manifest['split']):
+            raise Exception("Episode manifest {} holds {} tasks, not {} tasks.".format(path, str(manifest['split']), self.canonical_split(split)))
+        split = str(manifest['split'])
+        manifest['cursor'] = 0
+        self.manifests[split] = manifest
+        # number of tasks replayed by this shard
+        return len(range(self.rank, len(manifest['ids']), self.world_size))
+
+    def replay_manifest(self, batch_size=8, split='test', return_classes=False):
+        if split not in self.manifests:
+            raise Exception("No episode manifest loaded for split '{}'; see load_episode_manifest.".format(split))
+        manifest = self.manifests[split]
+        # tasks are handed out in order and wrap around at the end of the manifest; shard r replays tasks r, r + world_size, ...
+        with self._stats_lock:
+            task_ids = (self.rank + self.world_size * np.arange(manifest['cursor'], manifest['cursor'] + batch_size)) % len(manifest['ids'])
+            manifest['cursor'] += batch_size
+        batch = (manifest['ids'][task_ids], manifest['labels'][task_ids], manifest['raw_labels'][task_ids])
+        if return_classes:
+            return batch + (manifest['classes'][task_ids],)
+        return batch
+
+    def batch_ring(self, batch_size=8, size=2):
+        return BatchRing(size, batch_size, self.support_size, self.dataset.get_shape(), self.label_subset_size, pixel_dtype=self.dataset.pixel_dtype)
 
-    def gather_support(self, keys, indices, mode='greedy'):
+    def sample_batch(self, batch_size=8, split='train', mode='greedy', out=None):
+        # out=(images, labels, raw_labels) is filled in place, e.g. a buffer from BatchRing.acquire(); fresh buffers otherwise
+        if out is None:
+            _, out = self.batch_ring(batch_size, size=1).acquire()
+        # target shape: (batch_size, support, w, h) -> then we can collate
+        batch_support, batch_labels, batch_raw_labels = out
+        batch_ids, _, _ = self.sample_batch_indices(batch_size=batch_size, split=split, mode=mode, out=(batch_labels, batch_raw_labels))
+        # every patch of every task in the meta-batch is read in one go, straight into the batch buffer
+        self.dataset.get_images(batch_ids.ravel().tolist(), out=batch_support.reshape(-1, *batch_support.shape[2:]))
+        return batch_support, batch_labels, batch_raw_labels
+
+    def gather_support(self, keys, indices, mode='greedy', split=None, out=None):
+        seen, support_ids, temp_support_labels, raw_labels = self.select_support(keys, indices, mode=mode, split=split, rng=self.episode_rng(split))
+        if out is None:
+            out = np.zeros((self.support_size, *self.dataset.get_shape()), dtype=self.dataset.pixel_dtype)
+        support = self.dataset.get_images(list(support_ids), out=out)
+        return seen, support, temp_support_labels, raw_labels
+
+    def split_label_codes(self, split, indices, key_indices):
+        # label bitcodes of every patch in `indices`, restricted to (and re-indexed over) the split's classes
+        if split is not None and split in self._split_codes:
+            return self._split_codes[split]
+        codes = label_bitcodes(self.dataset.label_matrix[np.asarray(indices)][:, key_indices])
+        if split is not None:
+            self._split_codes[split] = codes
+        return codes
+
+    def rejection_stats(self):
+        with self._stats_lock:
+            return {split: {'drawn': drawn, 'accepted': accepted, 'rejection_rate': 1. - accepted / drawn if drawn else 0.}
+                    for split, (drawn, accepted) in self._rejection_counts.items()}
+
+    def select_support(self, keys, indices, mode='greedy', split=None, rng=None):
+        # chooses the patches of one task from label metadata alone; images are decoded by the caller
+        if rng is None:
+            rng = self.episode_rng(split)
         key_indices = [i for i, k in enumerate(self.counts.keys()) if k in keys]
         n_classes = len(key_indices)
-        support = np.zeros((self.support_size, *self.dataset.get_shape()))
+        support_ids = np.zeros((self.support_size,), dtype=np.int64)
         temp_support_labels = np.zeros((self.support_size, n_classes))
         raw_labels = np.zeros((self.support_size, self.label_subset_size))
         seen = np.zeros((n_classes,), dtype=int)
 
         loaded = 0
         if mode == 'greedy':
+            # rejection sampling against the label matrix: candidates are drawn in batches and tested with vectorized
+            # popcounts; each acceptance grows `seen`, so only the candidates after it are re-tested
+            codes = self.split_label_codes(split, indices, key_indices)
+            key_indices = np.array(key_indices, dtype=int)
+            seen_code = np.uint64(0)
+            drawn = 0
+            candidate_batch_size = max(4 * self.support_size, 64)
             while loaded < self.support_size:
-                idx = random.choice(indices)
-                img, label = self.dataset[idx]  # shape: (w, h), (n_classes)
-                raw_indices = np.intersect1d(np.where(label)[0], key_indices)
-                label = label[key_indices]
-                if np.count_nonzero(label | seen) > self.label_subset_size:
-                    continue
-                seen = label | seen
-                support[loaded, ...] = img
-                temp_support_labels[loaded, ...] = label
-                curr_label_indices = np.pad(raw_indices, (0, self.label_subset_size - len(raw_indices)), 'constant', constant_values=-1)
-                raw_labels[loaded, ...] = curr_label_indices
-                loaded += 1
+                candidates = rng.integers(len(indices), size=candidate_batch_size)
+                while len(candidates) and loaded < self.support_size:
+                    accept = popcount(codes[candidates] | seen_code) <= self.label_subset_size
+                    if not accept.any():
+                        drawn += len(candidates)
+                        break
+                    k = int(np.argmax(accept))
+                    drawn += k + 1
+                    pos = candidates[k]
+                    candidates = candidates[k + 1:]
+                    seen_code |= codes[pos]
+                    idx = indices[pos]
+                    label = self.dataset.label_matrix[idx, key_indices].astype(int)
+                    raw_indices = key_indices[label.astype(bool)]
+                    support_ids[loaded] = idx
+                    temp_support_labels[loaded, ...] = label
+                    curr_label_indices = np.pad(raw_indices, (0, self.label_subset_size - len(raw_indices)), 'constant', constant_values=-1)
+                    raw_labels[loaded, ...] = curr_label_indices
+                    loaded += 1
+            seen = (temp_support_labels.sum(axis=0) > 0).astype(int)
+            with self._stats_lock:
+                counts = self._rejection_counts[split]
+                counts[0] += drawn
+                counts[1] += loaded
         elif mode == 'permutation':
-            classes = np.array(random.sample(key_indices, k=self.label_subset_size), dtype=int)
-            powerset_labels = range(1 << self.label_subset_size)
-            support_indices = []
-            powerset_label_index_list = []
-            for perm in powerset_labels:
-                if not perm:
-                    continue
-                perm_string = '0{}b'.format(self.label_subset_size)
-                intersect_perm = [c for i, c in zip(format(perm, perm_string), classes) if i == '1']
-                exclude_perm = [c for i, c in zip(format(perm, perm_string), classes) if i == '0']
-                valid_indices = reduce(
-                    op.and_, [self.label_indices_dict[i] for i in intersect_perm])
-                excluded = [self.label_indices_dict[i] for i in exclude_perm]
-                if len(excluded):
-                    valid_indices = valid_indices - reduce(op.or_, [self.label_indices_dict[i] for i in exclude_perm])
-                powerset_label_index_list.append(valid_indices)
-            index_list_indices = list(range(len(powerset_label_index_list)))
-            random.shuffle(index_list_indices)
+            classes = rng.choice(key_indices, size=self.label_subset_size, replace=False)
+            # cell p holds the patches whose labels restricted to `classes` spell out p in binary
+            cells = self.label_combination_index.partition(classes)
+            if not cells.sizes()[1:].any():
+                raise Exception("No patches carry any of the sampled classes {}.".format(classes))
+            index_list_indices = list(range(1, 1 << self.label_subset_size))
+            rng.shuffle(index_list_indices)
             index_set_iter = cycle(index_list_indices)
             while loaded < self.support_size:
-                i = next(index_set_iter)
-                index_set = powerset_label_index_list[i]
-                if len(index_set):
+                perm = next(index_set_iter)
+                cell_size = cells.size(perm)
+                if cell_size:
 
-                    di = random.sample(index_set, 1)[0]
-                    img, label = self.dataset[di]
+                    di = cells.draw(perm, int(rng.integers(cell_size)))
+                    label = self.dataset.read_labels(di)
                     label[~np.isin(np.arange(len(label)), classes)] = 0
                     raw_indices = np.intersect1d(np.where(label)[0], key_indices)
                     label = label[key_indices]
 
                     seen = label | seen
-                    support[loaded, ...] = img
+                    support_ids[loaded] = di
                     temp_support_labels[loaded, ...] = label
                     curr_label_indices = np.pad(raw_indices, (0, self.label_subset_size - len(raw_indices)), 'constant', constant_values=-1)
                     raw_labels[loaded, ...] = curr_label_indices
                     loaded += 1
         elif mode == 'balanced':
-            pass
+            # an (almost) equal quota from every non-empty label combination of the sampled classes
+            classes = rng.choice(key_indices, size=self.label_subset_size, replace=False)
+            pool = self.split_pools[split] if split in self.split_pools else LabelCombinationIndex(self.label_codes, ids=indices)
+            cells = pool.partition(classes)
+            nonempty_cells = [int(p) for p in np.where(cells.sizes()[1:] > 0)[0] + 1]
+            if not nonempty_cells:
+                raise Exception("No patches carry any of the sampled classes {}.".format(classes))
+            quota, remainder = divmod(self.support_size, len(nonempty_cells))
+            cell_draws = nonempty_cells * quota + rng.choice(nonempty_cells, size=remainder, replace=False).tolist()
+            # shuffled so that the support and query halves see the same mix of combinations
+            rng.shuffle(cell_draws)
+            for perm in cell_draws:
+                di = cells.draw(perm, int(rng.integers(cells.size(perm))))
+                label = self.dataset.read_labels(di)
+                label[~np.isin(np.arange(len(label)), classes)] = 0
+                raw_indices = np.intersect1d(np.where(label)[0], key_indices)
+                label = label[key_indices]
+
+                seen = label | seen
+                support_ids[loaded] = di
+                temp_support_labels[loaded, ...] = label
+                curr_label_indices = np.pad(raw_indices, (0, self.label_subset_size - len(raw_indices)), 'constant', constant_values=-1)
+                raw_labels[loaded, ...] = curr_label_indices
+                loaded += 1
         else:
             raise ValueError("Keyword 'mode' must be one of 'greedy', 'permutation', or 'balanced' but got " + mode)
-        return seen, support, temp_support_labels, raw_labels
+        return seen, support_ids, temp_support_labels, raw_labels
+
+    def as_tf_dataset(self, batch_size=8, split='train', mode='greedy', multi=None, split_support_query=False):
+        # endless pipeline: tasks are sampled from label metadata, patches decoded in parallel and normalized in-graph;
+        # `multi` and `split_support_query` apply the same conversion as prefetch.make_episode_transform
+        raw_shape = self.dataset.read_raw(0).shape
+        n = self.label_subset_size
+
+        def tasks():
+            while True:
+                ids, labels, raw_labels = self.sample_batch_indices(batch_size=1, split=split, mode=mode)
+                yield ids[0], labels[0], raw_labels[0]
+
+        def read_raw(idx):
+            return np.asarray(self.dataset.read_raw(int(idx)), dtype=np.uint16)
+
+        def decode_patch(idx, label, raw_label):
+            img = tf.numpy_function(read_raw, [idx], tf.uint16)
+            img.set_shape(raw_shape)
+            if self.dataset.raw_pixels:
+                # left for the model to normalize
+                return img, label, raw_label
+            img = normalize_raw(img, _OPTICAL_MAX_VALUE, bands=self.dataset.bands)
+            if self.dataset.data_format == 'channels_first':
+                img = tf.transpose(img, (2, 0, 1))
+            return img, label, raw_label
+
+        def convert(images, labels, raw_labels):
+            labels = convert_to_powerset_tf(labels) if multi == 'powerset' else convert_to_bin_rel(labels)
+            if split_support_query:
+                input_tr, input_ts = tf.split(images, 2, axis=1)
+                label_tr, label_ts = tf.split(labels, 2, axis=1)
+                return input_tr, input_ts, label_tr, label_ts
+            return images, labels, raw_labels
+
+        ds = tf.data.Dataset.from_generator(tasks, output_types=(tf.int64, tf.float32, tf.float64),
+                                            output_shapes=((self.support_size,), (self.support_size, n), (self.support_size, n)))
+        # one element per patch, so decoding parallelizes across patches and not just across tasks
+        ds = ds.flat_map(lambda ids, labels, raw_labels: tf.data.Dataset.from_tensor_slices((ids, labels, raw_labels)))
+        ds = ds.map(decode_patch, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+        ds = ds.batch(self.support_size, drop_remainder=True).batch(batch_size, drop_remainder=True)
+        if multi is not None:
+            ds = ds.map(convert, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+        return ds.prefetch(tf.data.experimental.AUTOTUNE)
 
-    def get_train_val_test_indices(self, premade_split_file=None, split_save_path=None, rebuild=False):
+    def get_train_val_test_indices(self, cache_dir='.', seed=42, val_prop=0.25, test_prop=0.2, rebuild=False):
         if hasattr(self, 'train_indices') and hasattr(self, 'val_indices') and hasattr(self, 'test_indices') and not rebuild:
             return self.train_indices, self.val_indices, self.test_indices
-        train_indices, val_indices, test_indices = [], [], []
-        if premade_split_file and not rebuild:
-            print("Reloading train-val-test split cache from", premade_split_file)
-            try:
-                with open(premade_split_file, 'rb') as f:
-                    indices = pickle.load(f)
-                    self.train_keys, self.val_keys, self.test_keys = indices[
-                        'train_keys'], indices['val_keys'], indices['test_keys']
-                    return indices['train'], indices['val'], indices['test']
-            except OSError:
-                message = ("Creating new split instead with file name {}".format(
-                    split_save_path), "Attempting to create split with this file name.")[split_save_path is None]
-                print("File", premade_split_file,
-                      "not found. {}".format(message))
-                if split_save_path is None:
-                    split_save_path = premade_split_file
-        if split_save_path is None:
-            warnings.warn("Building index list, but not saving!")
-        print("Building new train-val-test split and saving to", split_save_path)
-        #self.labels = []
-        for i, patch in enumerate(tqdm(self.dataset.patches)):
-            with open(os.path.join(self.data_dir, patch, "{}_labels_metadata.json".format(patch)), 'r') as f:
-                metadata = json.load(f)
-                labels = set(metadata['labels'])
-                train_cardinality = len(labels & self.train_keys)
-                val_cardinality = len(labels & self.val_keys)
-                test_cardinality = len(labels & self.test_keys)
-                max_cardinality = max(
-                    train_cardinality, val_cardinality, test_cardinality)
-                if max_cardinality == train_cardinality:
-                    train_indices.append(i)
-                elif max_cardinality == val_cardinality:
-                    val_indices.append(i)
-                else:
-                    test_indices.append(i)
-                # self.labels.append(labels)
-        if split_save_path:
-            index_dict = {'train_keys': self.train_keys,
-                          'val_keys': self.val_keys,
-                          'test_keys': self.test_keys,
-                          'train': train_indices,
-                          'val': val_indices,
-                          'test': test_indices}
-            with open(split_save_path, 'wb') as f:
-                pickle.dump(index_dict, f)
-        return train_indices, val_indices, test_indices
+        splits = SplitTable.load(self.dataset.label_table, (self.train_keys, self.val_keys, self.test_keys), filter_files=self.dataset.filter_files,
+                                 seed=seed, val_prop=val_prop, test_prop=test_prop, cache_dir=cache_dir, rebuild=rebuild)
+        return splits.indices
@@ -0,0 +1,24 @@
+import os
+from argparse import ArgumentParser
+
+import load_data_tf as load_data
+
+if __name__ == '__main__':
+    psr = ArgumentParser()
+    psr.add_argument("--data-root", type=str, default="../cs330-storage", help="Path to all data")
+    psr.add_argument("--output", type=str, required=True, help="Where to write the manifest (.npz)")
+    psr.add_argument("--split", choices=['train', 'val', 'test'], default='test', help="Split to draw tasks from")
+    psr.add_argument("--num-tasks", type=int, default=600, help="Number of tasks to pre-generate")
+    psr.add_argument("--task-size", type=int, default=16, help="Examples per task, support and query together (2 * --support-size for maml.py, support + query for mann.py and protonets.py)")
+    psr.add_argument("--label-subset-size", type=int, default=3, help="Maximum cardinality of multi-labels in each task")
+    psr.add_argument("--sampling-mode", type=str, choices=['permutation', 'greedy', 'balanced'], default='greedy', help="Multi-label task sampling framework")
+    psr.add_argument("--packed-dir", type=str, default=None, help="Path to a packed patch store built by pack_data.py")
+    psr.add_argument("--seed", type=int, default=1, help="Seed for task sampling")
+    args = psr.parse_args()
+
+    filter_files = [os.path.join(args.data_root, 'patches_with_cloud_and_shadow.csv'), os.path.join(args.data_root, 'patches_with_seasonal_snow.csv')]
+    data_dir = os.path.join(args.data_root, "SmallEarthNet")
+    meta_dataset = load_data.MetaBigEarthNetTaskDataset(data_dir=data_dir, filter_files=filter_files, support_size=args.task_size, label_subset_size=args.label_subset_size, packed_dir=args.packed_dir, sampling_seed=args.seed)
+
+    print("Writing {} {} tasks to {}".format(args.num_tasks, args.split, args.output))
+    meta_dataset.write_episode_manifest(args.output, args.num_tasks, split=args.split, mode=args.sampling_mode)
@@ -0,0 +1,30 @@
+import os
+from argparse import ArgumentParser
+
+import load_data_tf as load_data
+from episode_shards import write_episode_shards
+
+if __name__ == '__main__':
+    psr = ArgumentParser()
+    psr.add_argument("--data-root", type=str, default="../cs330-storage", help="Path to all data")
+    psr.add_argument("--output-dir", type=str, required=True, help="Where to write the shards and their index")
+    psr.add_argument("--split", choices=['train', 'val', 'test'], default='train', help="Split to draw tasks from")
+    psr.add_argument("--num-episodes", type=int, default=100000, help="Number of episodes to pre-render")
+    psr.add_argument("--episodes-per-shard", type=int, default=1024, help="Episodes per shard file")
+    psr.add_argument("--task-size", type=int, default=16, help="Examples per task, support and query together (2 * --support-size for maml.py, support + query for mann.py and protonets.py)")
+    psr.add_argument("--label-subset-size", type=int, default=3, help="Maximum cardinality of multi-labels in each task")
+    psr.add_argument("--sampling-mode", type=str, choices=['permutation', 'greedy', 'balanced'], default='greedy', help="Multi-label task sampling framework")
+    psr.add_argument("--bands", choices=['rgb', 'all'], default='rgb', help="Which spectral bands to store")
+    psr.add_argument("--packed-dir", type=str, default=None, help="Path to a packed patch store built by pack_data.py")
+    psr.add_argument("--compression-level", type=int, default=6, help="zlib compression level of the episode records (0-9)")
+    psr.add_argument("--seed", type=int, default=1, help="Seed for task sampling")
+    args = psr.parse_args()
+
+    filter_files = [os.path.join(args.data_root, 'patches_with_cloud_and_shadow.csv'), os.path.join(args.data_root, 'patches_with_seasonal_snow.csv')]
+    data_dir = os.path.join(args.data_root, "SmallEarthNet")
+    meta_dataset = load_data.MetaBigEarthNetTaskDataset(data_dir=data_dir, filter_files=filter_files, support_size=args.task_size, label_subset_size=args.label_subset_size, mode=args.bands, packed_dir=args.packed_dir, sampling_seed=args.seed)
+
+    print("Writing {} {} episodes to {}".format(args.num_episodes, args.split, args.output_dir))
+    index = write_episode_shards(meta_dataset, args.output_dir, args.num_episodes, split=args.split, mode=args.sampling_mode,
+                                 episodes_per_shard=args.episodes_per_shard, compression_level=args.compression_level)
+    print("Wrote {} shards".format(len(index['shards'])))
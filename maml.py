@@ -14,7 +14,6 @@ import os
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '1'
 
 
-import random
 import sys
 import csv
 import pickle
@@ -29,6 +28,8 @@ import load_data_tf as load_data
 import models
 from utils import *
 from options import get_args
+from prefetch import episode_stream
+from tracing import count_traces, enable_trace_log, trace_summary
 from tensorboardX import SummaryWriter
 
 import logging
@@ -40,7 +41,7 @@ IMG_SIZE = 120
 
 
 class MAML(tf.keras.Model):
-    def __init__(self, dim_input=1, dim_output=1, num_inner_updates=1, inner_update_lr=0.4, num_filters=32, learn_inner_update_lr=False, model='VanillaConvModel', multi = 'powerset', num_classes=3):
+    def __init__(self, dim_input=1, dim_output=1, num_inner_updates=1, inner_update_lr=0.4, num_filters=32, learn_inner_update_lr=False, model='VanillaConvModel', multi = 'powerset', num_classes=3, channels=3, inner_loop='vectorized', meta_gradient='maml', anil=False):
         super(MAML, self).__init__()
         self.dim_input = dim_input
         self.num_classes = num_classes
@@ -48,7 +49,7 @@ class MAML(tf.keras.Model):
         self.inner_update_lr = inner_update_lr
         self.loss_func = partial(cross_entropy_loss)
         self.dim_hidden = num_filters
-        self.channels = 3
+        self.channels = channels
         self.img_size = int(np.sqrt(self.dim_input / self.channels))
         self.multi = multi
 
@@ -72,6 +73,20 @@ class MAML(tf.keras.Model):
         else:
             raise ValueError("Model name '{}' is not supported!")
 
+        # 'vectorized' adapts the whole meta-batch at once (see batched_inner_loop); 'map_fn' adapts one task at a time
+        if inner_loop not in ['vectorized', 'map_fn']:
+            raise ValueError("Keyword 'inner_loop' must be one of 'vectorized' or 'map_fn' but got " + inner_loop)
+        self.vectorized = inner_loop == 'vectorized' and hasattr(self.inner_model, 'call_batched')
+        # 'maml' differentiates through the inner loop; 'fomaml' and 'reptile' treat the inner gradients as constants,
+        # so the inner forward and backward passes are not kept alive for the outer gradient
+        if meta_gradient not in ['maml', 'fomaml', 'reptile']:
+            raise ValueError("Keyword 'meta_gradient' must be one of 'maml', 'fomaml', or 'reptile' but got " + meta_gradient)
+        self.meta_gradient = meta_gradient
+        # ANIL: the inner loop adapts only the output layer, on backbone features computed once per task
+        if anil and not hasattr(self.inner_model, 'head'):
+            raise ValueError("Model '{}' does not separate a backbone from its head, which ANIL adaptation requires.".format(model))
+        self.anil = anil
+
         self.learn_inner_update_lr = learn_inner_update_lr
         if self.learn_inner_update_lr:
             self.inner_update_lr_dict = {}
@@ -80,8 +95,95 @@ class MAML(tf.keras.Model):
                     tf.Variable(self.inner_update_lr, name='inner_update_lr_%s_%d' %
                         (key, j)) for j in range(num_inner_updates)]
 
+    def inner_update(self, weights, grads):
+        if self.meta_gradient != 'maml':
+            # first-order: the adapted weights depend on the initial ones through the identity only
+            grads = {key: tf.stop_gradient(grad) for key, grad in grads.items()}
+        if self.learn_inner_update_lr:
+            weights = dict(zip(weights.keys(), [weights[key] - self.inner_update_lr_dict[key] * grads[key] for key in weights])) # might need to make a TF op? probably OK
+        else:
+            weights = dict(zip(weights.keys(), [weights[key] - self.inner_update_lr * grads[key] for key in weights])) # might need to make a TF op? probably OK
+        if self.meta_gradient == 'reptile':
+            # the outer gradient of the adapted weights comes from reptile_loss instead
+            weights = {key: tf.stop_gradient(w) for key, w in weights.items()}
+        return weights
+
+    def reptile_loss(self, loss_ts, initial_weights, weights, batched=False):
+        # keeps the value of the query loss, but its gradient w.r.t. the initial weights becomes the Reptile direction
+        # initial - adapted (that of 0.5 * ||initial - adapted||^2); weights that are not adapted keep the query loss gradient
+        surrogate = tf.add_n([0.5 * tf.reduce_sum(tf.square(initial_weights[key] - weights[key]), axis=list(range(1, len(weights[key].shape))) if batched else None)
+                              for key in weights])
+        return loss_ts + surrogate - tf.stop_gradient(surrogate)
+
+    def first_order_outputs(self, output_tr_pre, loss_tr_pre, outputs_ts, losses_ts):
+        # only the final query loss is differentiated. Under first-order meta-gradients nothing else needs a backward
+        # pass, so the pre-update and intermediate outputs are cut off the tape and their activations are not kept
+        if self.meta_gradient == 'maml':
+            return output_tr_pre, loss_tr_pre, outputs_ts, losses_ts
+        outputs_ts = [tf.stop_gradient(output) for output in outputs_ts[:-1]] + outputs_ts[-1:]
+        losses_ts = [tf.stop_gradient(loss) for loss in losses_ts[:-1]] + losses_ts[-1:]
+        return tf.stop_gradient(output_tr_pre), tf.stop_gradient(loss_tr_pre), outputs_ts, losses_ts
+
+    def batched_inner_loop(self, inp, meta_batch_size, num_inner_updates=1):
+        """ The inner loop of every task at once: fast weights are stacked along a leading task axis and the inner
+        model runs on the whole meta-batch (call_batched). Returns what tf.map_fn over task_inner_loop would. """
+        input_tr, input_ts, label_tr, label_ts = inp
+        weights = {key: tf.broadcast_to(w, [meta_batch_size] + w.shape.as_list()) for key, w in self.inner_model.model_weights.items()}
+        forward = self.inner_model.call_batched
+        if self.anil:
+            # every inner step and the query set reuse these; only the head weights are adapted. The backbone weights
+            # are the same for every task, so it runs as one ordinary batch of tasks * N images
+            def features(x):
+                hidden = self.inner_model.backbone(tf.reshape(x, [-1] + x.shape[2:].as_list()), self.inner_model.model_weights)
+                return tf.reshape(hidden, tf.concat([tf.shape(x)[:2], tf.shape(hidden)[1:]], axis=0))
+            input_tr, input_ts = features(input_tr), features(input_ts)
+            weights = {key: weights[key] for key in self.inner_model.head_keys}
+            forward = self.inner_model.head
+        initial_weights = weights
+
+        task_output_tr_pre, task_loss_tr_pre = None, None
+        task_outputs_ts, task_losses_ts = [], []
+        for i in range(num_inner_updates):
+            with tf.GradientTape() as tape:
+                for key in weights: tape.watch(weights[key])
+                output_tr = forward(input_tr, weights)
+                task_loss_tr = task_cross_entropy_loss(output_tr, label_tr)
+                # tasks only interact through the sum, so its gradient holds every task's own gradient
+                loss_tr = tf.reduce_sum(task_loss_tr)
+            if i == 0:
+                # the pre-update forward pass doubles as the first inner step's
+                task_output_tr_pre, task_loss_tr_pre = output_tr, task_loss_tr
+            grads = dict(zip(weights.keys(), tape.gradient(loss_tr, list(weights.values()))))
+            weights = self.inner_update(weights, grads)
+
+            output_ts = forward(input_ts, weights)
+            task_outputs_ts.append(output_ts)
+            task_losses_ts.append(task_cross_entropy_loss(output_ts, label_ts))
+        if task_output_tr_pre is None:
+            task_output_tr_pre = forward(input_tr, weights)
+            task_loss_tr_pre = task_cross_entropy_loss(task_output_tr_pre, label_tr)
+        if self.meta_gradient == 'reptile' and num_inner_updates > 0:
+            task_losses_ts[-1] = self.reptile_loss(task_losses_ts[-1], initial_weights, weights, batched=True)
+        task_output_tr_pre, task_loss_tr_pre, task_outputs_ts, task_losses_ts = self.first_order_outputs(task_output_tr_pre, task_loss_tr_pre, task_outputs_ts, task_losses_ts)
+
+        label_dense_tr = tf.cast(tf.argmax(input=label_tr, axis=-1), tf.int32)
+        preds_tr = tf.cast(tf.argmax(input=task_output_tr_pre, axis=-1), tf.int32)
+        task_precision_tr_pre, task_recall_tr_pre, task_f1_tr_pre = task_precision_recall_fscore(label_dense_tr, preds_tr, self.num_classes, multi=self.multi)
+
+        task_precision_ts, task_recall_ts, task_f1_ts = [], [], []
+        label_dense_ts = tf.cast(tf.argmax(input=label_ts, axis=-1), tf.int32)
+        for j in range(num_inner_updates):
+            preds_ts = tf.cast(tf.argmax(input=task_outputs_ts[j], axis=-1), tf.int32)
+            task_prec, task_rec, task_f1 = task_precision_recall_fscore(label_dense_ts, preds_ts, self.num_classes, multi=self.multi)
+            task_precision_ts.append(task_prec)
+            task_recall_ts.append(task_rec)
+            task_f1_ts.append(task_f1)
+
+        return [task_output_tr_pre, task_outputs_ts, task_loss_tr_pre, task_losses_ts, task_precision_tr_pre, task_precision_ts, task_recall_tr_pre, task_recall_ts, task_f1_tr_pre, task_f1_ts]
+
     
     @tf.function
+    @count_traces
     def call(self, inp, meta_batch_size=25, num_inner_updates=1):
 
         def task_inner_loop(inp, reuse=True,
@@ -92,6 +194,12 @@ class MAML(tf.keras.Model):
 
             # weights corresponds to the initial weights in MAML 
             weights = self.inner_model.model_weights.copy()
+            forward = self.inner_model
+            if self.anil:
+                # every inner step and the query set reuse these; only the head weights are adapted
+                input_tr, input_ts = self.inner_model.backbone(input_tr, weights), self.inner_model.backbone(input_ts, weights)
+                weights = {key: weights[key] for key in self.inner_model.head_keys}
+                forward = self.inner_model.head
 
             # the predicted outputs, loss values, and accuracy for the pre-update model (with the initial weights), evaluated on the inner loop training data
             task_output_tr_pre, task_loss_tr_pre = None, None
@@ -102,23 +210,23 @@ class MAML(tf.keras.Model):
             task_outputs_ts, task_losses_ts = [], []
             task_precision_ts, task_recall_ts, task_f1_ts = [], [], []
 
-            task_output_tr_pre = self.inner_model(input_tr, weights)
+            task_output_tr_pre = forward(input_tr, weights)
             task_loss_tr_pre = self.loss_func(task_output_tr_pre, label_tr)
             for i in range(num_inner_updates):
-                with tf.GradientTape(persistent=True) as tape: # keep track of high-order derivs on train data only, and use those to update
+                with tf.GradientTape() as tape: # keep track of high-order derivs on train data only, and use those to update
                     for key in weights: tape.watch(weights[key])
-                    output_tr = self.inner_model(input_tr, weights) 
+                    output_tr = forward(input_tr, weights) 
                     loss_tr = self.loss_func(output_tr, label_tr)
                 grads = dict(zip(weights.keys(), tape.gradient(loss_tr, list(weights.values())))) # might need to make a TF op 
-                if self.learn_inner_update_lr:
-                    weights = dict(zip(weights.keys(), [weights[key] - self.inner_update_lr_dict[key] * grads[key] for key in weights])) # might need to make a TF op? probably OK
-                else:
-                    weights = dict(zip(weights.keys(), [weights[key] - self.inner_update_lr * grads[key] for key in weights])) # might need to make a TF op? probably OK
+                weights = self.inner_update(weights, grads)
 
                 # post-update metrics on test
-                output_ts = self.inner_model(input_ts, weights)
+                output_ts = forward(input_ts, weights)
                 task_outputs_ts.append(output_ts) # TODO: Make TF op
                 task_losses_ts.append(self.loss_func(output_ts, label_ts)) # TODO: Make TF op
+            if self.meta_gradient == 'reptile' and num_inner_updates > 0:
+                task_losses_ts[-1] = self.reptile_loss(task_losses_ts[-1], self.inner_model.model_weights, weights)
+            task_output_tr_pre, task_loss_tr_pre, task_outputs_ts, task_losses_ts = self.first_order_outputs(task_output_tr_pre, task_loss_tr_pre, task_outputs_ts, task_losses_ts)
 
             #############################
 
@@ -141,9 +249,10 @@ class MAML(tf.keras.Model):
             return task_output
 
         input_tr, input_ts, label_tr, label_ts = inp
-        # to initialize the batch norm vars, might want to combine this, and
-        # not run idx 0 twice.
-        unused = task_inner_loop((input_tr[0], input_ts[0], label_tr[0], label_ts[0]), False, meta_batch_size, num_inner_updates)
+        # uint16 reflectances are scaled and normalized here, in one fused op
+        input_tr, input_ts = prepare_images(input_tr), prepare_images(input_ts)
+        if self.vectorized:
+            return self.batched_inner_loop((input_tr, input_ts, label_tr, label_ts), input_tr.shape[0] or tf.shape(input_tr)[0], num_inner_updates)
         out_dtype = [tf.float32, [tf.float32] * num_inner_updates] * 5
         #             tf.float32, [tf.float32] * num_inner_updates]
         #out_dtype.extend([tf.float32, [tf.float32] * num_inner_updates])
@@ -176,7 +285,8 @@ def outer_train_step(inp, model, optim, meta_batch_size=25, num_inner_updates=1)
 
     gradients = outer_tape.gradient(
         total_losses_ts[-1], model.trainable_variables)
-    optim.apply_gradients(zip(gradients, model.trainable_variables))
+    # e.g. learned inner learning rates under first-order meta-gradients have none
+    optim.apply_gradients([(grad, var) for grad, var in zip(gradients, model.trainable_variables) if grad is not None])
 
     total_loss_tr_pre = tf.reduce_mean(loss_tr_pre)
     #total_accuracy_tr_pre = tf.reduce_mean(accuracies_tr_pre)
@@ -212,7 +322,42 @@ def outer_eval_step(inp, model, meta_batch_size=25, num_inner_updates=1):
     return outputs_tr, outputs_ts, total_loss_tr_pre, total_losses_ts, total_precision_tr_pre, total_precision_ts, total_recall_tr_pre, total_recall_ts, total_f1_tr_pre, total_f1_ts
 
 
-def meta_train_fn(model, sampling_mode, exp_string, meta_dataset, writer, support_size=8, meta_train_iterations=15000, meta_batch_size=16, log=True, logdir='/tmp/data', num_inner_updates=1, meta_lr=0.001, log_frequency=5, test_log_frequency=25, multi='powerset'):
+def episode_signature(meta_batch_size, support_size, image_shape, dim_output, multi='powerset', pixel_dtype=tf.float32):
+    # (input_tr, input_ts, label_tr, label_ts) as produced by episode_stream(..., split_support_query=True)
+    images = tf.TensorSpec([meta_batch_size, support_size] + list(image_shape), pixel_dtype)
+    if multi == 'powerset':
+        labels = tf.TensorSpec([meta_batch_size, support_size, dim_output], tf.float32)
+    else:
+        labels = tf.TensorSpec([meta_batch_size, support_size, dim_output, 2], tf.float32)
+    return (images, images, labels, labels)
+
+
+
+def compile_outer_steps(model, optim, signature, num_inner_updates=1, jit_compile=False):
+    """ outer_train_step and outer_eval_step, each traced once into a single graph for episodes matching `signature`.
+
+    With jit_compile the whole step, inner loop and optimizer update included, is compiled by XLA.
+    """
+    if jit_compile and not model.vectorized:
+        raise ValueError("jit_compile requires the vectorized inner loop; the map_fn inner loop computes its metrics with dynamically shaped masks.")
+    meta_batch_size = signature[0].shape[0]
+    if hasattr(optim, 'build'):
+        # slot variables are created up front, not inside the compiled step
+        optim.build(model.trainable_variables)
+
+    @tf.function(input_signature=[signature], jit_compile=jit_compile)
+    @count_traces
+    def train_step(inp):
+        return outer_train_step(inp, model, optim, meta_batch_size=meta_batch_size, num_inner_updates=num_inner_updates)
+
+    @tf.function(input_signature=[signature], jit_compile=jit_compile)
+    @count_traces
+    def eval_step(inp):
+        return outer_eval_step(inp, model, meta_batch_size=meta_batch_size, num_inner_updates=num_inner_updates)
+    return train_step, eval_step
+
+
+def meta_train_fn(model, sampling_mode, exp_string, meta_dataset, writer, support_size=8, meta_train_iterations=15000, meta_batch_size=16, log=True, logdir='/tmp/data', num_inner_updates=1, meta_lr=0.001, log_frequency=5, test_log_frequency=25, multi='powerset', prefetch_depth=0, prefetch_workers=1, tf_data=False, val_sampling_mode=None, train_shards=None, shuffle_buffer=256, jit_compile=False):
 
     pre_accuracies, post_accuracies = [], []
     pre_loss, post_loss = [], []
@@ -221,8 +366,12 @@ def meta_train_fn(model, sampling_mode, exp_string, meta_dataset, writer, suppor
     pre_f1, post_f1 = [], []
 
     optimizer = tf.keras.optimizers.Adam(learning_rate=meta_lr)
+    signature = episode_signature(meta_batch_size, support_size, meta_dataset.dataset.get_shape(), model.dim_output, multi=multi, pixel_dtype=tf.as_dtype(meta_dataset.dataset.pixel_dtype))
+    train_step, eval_step = compile_outer_steps(model, optimizer, signature, num_inner_updates=num_inner_updates, jit_compile=jit_compile)
 
     plot_accuracies = []
+    train_episodes = episode_stream(meta_dataset, batch_size=meta_batch_size, split='train', mode=sampling_mode, multi=multi, split_support_query=True, depth=prefetch_depth, num_workers=prefetch_workers, tf_data=tf_data, shard_dir=train_shards, shuffle_buffer=shuffle_buffer)
+    val_episodes = episode_stream(meta_dataset, batch_size=meta_batch_size, split='val', mode=val_sampling_mode or sampling_mode, multi=multi, split_support_query=True, depth=prefetch_depth, num_workers=1, tf_data=tf_data)
     for itr in range(meta_train_iterations):
         #############################
 
@@ -231,10 +380,8 @@ def meta_train_fn(model, sampling_mode, exp_string, meta_dataset, writer, suppor
         # NOTE: The code assumes that the support and query sets have the same
         # number of examples.
 
-        X, y, y_debug = meta_dataset.sample_batch(batch_size=meta_batch_size, split='train', mode=sampling_mode)
+        inp = next(train_episodes)
         #X = tf.reshape(X, [meta_batch_size, support_size, -1])
-        converter = convert_to_powerset if multi == 'powerset' else convert_to_bin_rel
-        inp = support_query_split(X, y, converter, support_dim=1)
         """
         input_tr, input_ts = tf.split(X, 2, axis=1)
         single_labels = (np.packbits(y.astype(int), 2, 'little') - 1).reshape((len(y), -1))
@@ -246,7 +393,7 @@ def meta_train_fn(model, sampling_mode, exp_string, meta_dataset, writer, suppor
 
         #inp = (input_tr, input_ts, label_tr, label_ts)
         start = time.time()
-        result = outer_train_step(inp, model, optimizer, meta_batch_size=meta_batch_size, num_inner_updates=num_inner_updates)
+        result = train_step(inp)
         outputs_tr, outputs_ts, total_loss_tr_pre, total_losses_ts, total_precision_tr_pre, total_precision_ts, total_recall_tr_pre, total_recall_ts, total_f1_tr_pre, total_f1_ts = result
 
         # log metrics here
@@ -265,6 +412,10 @@ def meta_train_fn(model, sampling_mode, exp_string, meta_dataset, writer, suppor
             #print_str = 'Iteration %d: pre-inner-loop train loss/accuracy: %.5f/%.5f, post-inner-loop validation loss/accuracy: %.5f/%.5f, time elapsed: %.4fs' % (itr, np.mean(pre_loss), np.mean(pre_accuracies), np.mean(post_loss), np.mean(post_accuracies), time.time() - start)
             print_str = "Iteration {}: pre-inner train loss/prec./rec./F1: {:.5f}/{:.5f}/{:.5f}/{:.5f}, post-inner train loss/prec./rec./F1: {:.5f}/{:.5f}/{:.5f}/{:.5f}, time elapsed: {:.4f}s".format(itr, np.mean(pre_loss), np.mean(pre_precision), np.mean(pre_recall), np.mean(pre_f1), np.mean(post_loss), np.mean(post_precision), np.mean(post_recall), np.mean(post_f1), time.time() - start)
             print(print_str)
+            if meta_dataset.dataset.image_cache is not None:
+                print("Image cache:", meta_dataset.dataset.image_cache)
+            if sampling_mode == 'greedy':
+                print("Greedy sampling rejection rates:", {split: round(stats['rejection_rate'], 4) for split, stats in meta_dataset.rejection_stats().items()})
 
             writer.add_scalar('Inner loss', np.mean(post_loss), itr)
             writer.add_scalar('Inner precision', np.mean(post_precision), itr)
@@ -286,18 +437,16 @@ def meta_train_fn(model, sampling_mode, exp_string, meta_dataset, writer, suppor
             same number of examples.
             """
 
-            X, y, y_debug = meta_dataset.sample_batch(batch_size=meta_batch_size, split='val', mode=sampling_mode)
+            inp = next(val_episodes)
             #X = tf.reshape(X, [meta_batch_size, support_size, -1])
 
-            converter = convert_to_powerset if multi == 'powerset' else convert_to_bin_rel
-            inp = support_query_split(X, y, converter, support_dim=1)
             # input_tr, input_ts = tf.split(X, 2, axis=1)
             # single_labels = (np.packbits(y.astype(int), 2,'little') - 1).reshape((len(y), -1))
             # one_hot = np.eye(num_classes)[single_labels]
             # label_tr, label_ts = tf.split(one_hot, 2, axis=1)
 
             # inp = (input_tr, input_ts, label_tr, label_ts)
-            result = outer_eval_step(inp, model, meta_batch_size=meta_batch_size, num_inner_updates=num_inner_updates)
+            result = eval_step(inp)
             outputs_tr, outputs_ts, total_loss_tr_pre, total_losses_ts, total_precision_tr_pre, total_precision_ts, total_recall_tr_pre, total_recall_ts, total_f1_tr_pre, total_f1_ts = result
 
             #print('Meta-validation pre-inner-loop train accuracy: %.5f, meta-validation post-inner-loop test accuracy: %.5f' % (result[-2], result[-1][-1]))
@@ -310,11 +459,16 @@ def meta_train_fn(model, sampling_mode, exp_string, meta_dataset, writer, suppor
             writer.add_scalar('Outer F1', float(total_f1_ts[-1]), itr)
             #plot_accuracies.append(result[-1][-1])
 
+    train_episodes.close()
+    val_episodes.close()
+
     #plt.plot(np.arange(50, meta_train_iterations, 50), plot_accuracies)
     #plt.ylabel('Validation Accuracy')
     #plt.title('Question 1.4')
     #plt.show()
 
+    print("Traced graphs:", trace_summary())
+
     model_file = logdir + '/' + exp_string + '/model' + str(itr)
     print("Saving to ", model_file)
     model.save_weights(model_file)
@@ -324,15 +478,15 @@ def meta_train_fn(model, sampling_mode, exp_string, meta_dataset, writer, suppor
 NUM_META_TEST_POINTS = 600
 
 
-def meta_test_fn(model, meta_dataset, sampling_mode, writer, support_size=8, meta_batch_size=25, num_inner_updates=1, multi='powerset'):
+def meta_test_fn(model, meta_dataset, sampling_mode, writer, support_size=8, meta_batch_size=25, num_inner_updates=1, multi='powerset', prefetch_depth=0, prefetch_workers=1, tf_data=False, num_points=NUM_META_TEST_POINTS, jit_compile=False):
     #num_classes = data_generator.num_classes
 
-    np.random.seed(1)
-    random.seed(1)
-
     meta_test_losses, meta_test_precision, meta_test_recall, meta_test_f1 = [],  [], [],  []
+    signature = episode_signature(meta_batch_size, support_size, meta_dataset.dataset.get_shape(), model.dim_output, multi=multi, pixel_dtype=tf.as_dtype(meta_dataset.dataset.pixel_dtype))
+    _, eval_step = compile_outer_steps(model, None, signature, num_inner_updates=num_inner_updates, jit_compile=jit_compile)
+    test_episodes = episode_stream(meta_dataset, batch_size=meta_batch_size, split='test', mode=sampling_mode, multi=multi, split_support_query=True, depth=prefetch_depth, num_workers=prefetch_workers, tf_data=tf_data)
 
-    for itr in tqdm(range(NUM_META_TEST_POINTS)):
+    for itr in tqdm(range(num_points)):
 
 
         # sample a batch of test data and partition it into
@@ -340,10 +494,8 @@ def meta_test_fn(model, meta_dataset, sampling_mode, writer, support_size=8, met
         # NOTE: The code assumes that the support and query sets have the same
         # number of examples.
 
-        X, y, y_debug = meta_dataset.sample_batch(batch_size=meta_batch_size, split='test', mode=sampling_mode)
+        inp = next(test_episodes)
         #X = tf.reshape(X, [meta_batch_size, support_size, -1])
-        converter = convert_to_powerset if multi == 'powerset' else convert_to_bin_rel
-        inp = support_query_split(X, y, converter, support_dim=1)
         # input_tr, input_ts = tf.split(X, 2, axis=1)
         # single_labels = (np.packbits(y.astype(int), 2, 'little') - 1).reshape((len(y), -1))
         # one_hot = np.eye(num_classes)[single_labels]
@@ -351,7 +503,7 @@ def meta_test_fn(model, meta_dataset, sampling_mode, writer, support_size=8, met
 
         #############################
         #inp = (input_tr, input_ts, label_tr, label_ts)
-        result = outer_eval_step(inp, model, meta_batch_size=meta_batch_size, num_inner_updates=num_inner_updates)
+        result = eval_step(inp)
         outputs_tr, outputs_ts, total_loss_tr_pre, total_losses_ts, total_precision_tr_pre, total_precision_ts, total_recall_tr_pre, total_recall_ts, total_f1_tr_pre, total_f1_ts = result
 
         #eval_print_str = "Meta-test pre-inner loss/prec./rec./F1: {:.5f}/{:.5f}/{:.5f}/{:.5f}, meta-test post-inner loss/prec./rec./F1: {:.5f}/{:.5f}/{:.5f}/{:.5f}".format(total_loss_tr_pre, total_precision_tr_pre, total_recall_tr_pre, total_f1_tr_pre, total_losses_ts[-1], total_precision_ts[-1], total_recall_ts[-1], total_f1_ts[-1])
@@ -366,17 +518,20 @@ def meta_test_fn(model, meta_dataset, sampling_mode, writer, support_size=8, met
         writer.add_scalar('Meta-test recall', float(total_recall_ts[-1]), itr)
         writer.add_scalar('Meta-test F1', float(total_f1_ts[-1]), itr)
 
+    test_episodes.close()
+    print("Traced graphs:", trace_summary())
+
     #meta_test_accuracies = np.array(meta_test_accuracies)
     #means = np.mean(meta_test_accuracies)
     #stds = np.std(meta_test_accuracies)
     #ci95 = 1.96 * stds / np.sqrt(NUM_META_TEST_POINTS)
-    print("Mean meta-test loss:", np.mean(meta_test_losses), "+/-", 1.96 * np.std(meta_test_losses) / np.sqrt(NUM_META_TEST_POINTS))
-    print("Mean meta-test precision:", np.mean(meta_test_precision), "+/-", 1.96 * np.std(meta_test_precision) / np.sqrt(NUM_META_TEST_POINTS))
-    print("Mean meta-test recall:", np.mean(meta_test_recall), "+/-", 1.96 * np.std(meta_test_recall) / np.sqrt(NUM_META_TEST_POINTS))
-    print("Mean meta-test F1:", np.mean(meta_test_f1), "+/-", 1.96 * np.std(meta_test_f1) / np.sqrt(NUM_META_TEST_POINTS))
+    print("Mean meta-test loss:", np.mean(meta_test_losses), "+/-", 1.96 * np.std(meta_test_losses) / np.sqrt(num_points))
+    print("Mean meta-test precision:", np.mean(meta_test_precision), "+/-", 1.96 * np.std(meta_test_precision) / np.sqrt(num_points))
+    print("Mean meta-test recall:", np.mean(meta_test_recall), "+/-", 1.96 * np.std(meta_test_recall) / np.sqrt(num_points))
+    print("Mean meta-test F1:", np.mean(meta_test_f1), "+/-", 1.96 * np.std(meta_test_f1) / np.sqrt(num_points))
 
 
-def run_maml(support_size=8, meta_batch_size=4, meta_lr=0.001, inner_update_lr=0.4, num_filters=32, num_inner_updates=1, learn_inner_update_lr=False, resume=False, resume_itr=0, log=True, sampling_mode='greedy', logdir='./checkpoints', data_root="../cs330-storage/", meta_train=True, meta_train_iterations=15000, meta_train_inner_update_lr=-1, label_subset_size=3, log_frequency=5, test_log_frequency=25, experiment_name=None, model_class="VanillaConvModel", multilabel_scheme = 'powerset'):
+def run_maml(support_size=8, meta_batch_size=4, meta_lr=0.001, inner_update_lr=0.4, num_filters=32, num_inner_updates=1, learn_inner_update_lr=False, resume=False, resume_itr=0, log=True, sampling_mode='greedy', logdir='./checkpoints', data_root="../cs330-storage/", meta_train=True, meta_train_iterations=15000, meta_train_inner_update_lr=-1, label_subset_size=3, log_frequency=5, test_log_frequency=25, experiment_name=None, model_class="VanillaConvModel", multilabel_scheme = 'powerset', mode='rgb', packed_dir=None, image_cache_mb=0, io_threads=None, raw_pixels=False, prefetch_depth=0, prefetch_workers=1, tf_data=False, val_manifest=None, test_manifest=None, train_shards=None, shuffle_buffer=256, inner_loop='vectorized', meta_gradient='maml', anil=False, jit_compile=False):
 
     experiment_fullname = generate_experiment_name(experiment_name, ['train' if meta_train else 'test', Path(__file__).stem])
 
@@ -389,41 +544,63 @@ def run_maml(support_size=8, meta_batch_size=4, meta_lr=0.001, inner_update_lr=0
     filter_files = [os.path.join(data_root, 'patches_with_cloud_and_shadow.csv'), os.path.join(data_root, 'patches_with_seasonal_snow.csv')]  # replace with your path
 
     data_dir = os.path.join(data_root, "SmallEarthNet")
-    meta_dataset = load_data.MetaBigEarthNetTaskDataset(data_dir=data_dir, filter_files=filter_files, support_size=2 * support_size, label_subset_size=label_subset_size, split_save_path="smallearthnet.pkl", split_file="smallearthnet.pkl")
+    meta_dataset = load_data.MetaBigEarthNetTaskDataset(data_dir=data_dir, filter_files=filter_files, support_size=2 * support_size, label_subset_size=label_subset_size, mode=mode, packed_dir=packed_dir, image_cache_bytes=image_cache_mb * 2**20, io_threads=io_threads, raw_pixels=raw_pixels)
+    # pre-generated tasks (see make_episode_manifest.py) are replayed instead of sampled
+    val_sampling_mode = None
+    if val_manifest:
+        meta_dataset.load_episode_manifest(val_manifest, split='val')
+        val_sampling_mode = 'manifest'
 
     # set up MAML model
     dim_output = 2**label_subset_size - 1 if multilabel_scheme == 'powerset' else label_subset_size
-    dim_input = (IMG_SIZE**2) * 3
+    channels = len(meta_dataset.dataset.bands)
+    dim_input = (IMG_SIZE**2) * channels
 
-    model = MAML(dim_input, dim_output, num_inner_updates=num_inner_updates, inner_update_lr=inner_update_lr, num_filters=num_filters, learn_inner_update_lr=learn_inner_update_lr, model=model_class, multi = multilabel_scheme)
+    model = MAML(dim_input, dim_output, num_inner_updates=num_inner_updates, inner_update_lr=inner_update_lr, num_filters=num_filters, learn_inner_update_lr=learn_inner_update_lr, model=model_class, multi = multilabel_scheme, channels=channels, inner_loop=inner_loop, meta_gradient=meta_gradient, anil=anil)
 
     if meta_train_inner_update_lr == -1:
         meta_train_inner_update_lr = inner_update_lr
 
     exp_string = 'supsize_' + str(support_size) + '.mbs_' + str(meta_batch_size) + '.inner_numstep_' + str(
         num_inner_updates) + '.inner_updatelr_' + str(meta_train_inner_update_lr) + '.learn_inner_update_lr_' + str(learn_inner_update_lr)
+    if mode != 'rgb':
+        # checkpoints are not interchangeable between band sets
+        exp_string += '.bands_' + mode
+    if meta_gradient != 'maml':
+        exp_string += '.meta_grad_' + meta_gradient
+    if anil:
+        exp_string += '.anil'
 
     if meta_train:
-        meta_train_fn(model, sampling_mode, exp_string, meta_dataset, writer, support_size, meta_train_iterations, meta_batch_size, log, logdir, num_inner_updates, meta_lr, log_frequency=log_frequency, test_log_frequency=test_log_frequency, multi = multilabel_scheme)
+        meta_train_fn(model, sampling_mode, exp_string, meta_dataset, writer, support_size, meta_train_iterations, meta_batch_size, log, logdir, num_inner_updates, meta_lr, log_frequency=log_frequency, test_log_frequency=test_log_frequency, multi = multilabel_scheme, prefetch_depth=prefetch_depth, prefetch_workers=prefetch_workers, tf_data=tf_data, val_sampling_mode=val_sampling_mode, train_shards=train_shards, shuffle_buffer=shuffle_buffer, jit_compile=jit_compile)
     else:
         meta_batch_size = 1
+        num_test_points = NUM_META_TEST_POINTS
+        if test_manifest:
+            num_test_points = meta_dataset.load_episode_manifest(test_manifest, split='test') // meta_batch_size
+            sampling_mode = 'manifest'
 
         model_file = tf.train.latest_checkpoint(logdir + '/' + exp_string)
         print("Restoring model weights from ", model_file)
         model.load_weights(model_file)
 
-        meta_test_fn(model, sampling_mode, meta_dataset, writer, support_size, meta_batch_size, num_inner_updates, multi = multilabel_scheme)
+        meta_test_fn(model, meta_dataset, sampling_mode, writer, support_size, meta_batch_size, num_inner_updates, multi = multilabel_scheme, prefetch_depth=prefetch_depth, prefetch_workers=prefetch_workers, tf_data=tf_data, num_points=num_test_points, jit_compile=jit_compile)
 
 
 def main(args):
     print(args.multilabel_scheme)
+    if args.trace_log:
+        enable_trace_log()
     run_maml(support_size=args.support_size, inner_update_lr=args.inner_update_lr,
             num_inner_updates=args.num_inner_updates, meta_train_iterations=args.iterations,
             learn_inner_update_lr=args.learn_inner_lr, meta_train=not args.test,
             label_subset_size=args.label_subset_size, log_frequency=args.log_frequency,
             test_log_frequency=args.test_log_frequency, data_root=args.data_root,
             experiment_name=args.experiment_name, model_class=args.model_class_name,
-            sampling_mode=args.sampling_mode, multilabel_scheme = args.multilabel_scheme)
+            sampling_mode=args.sampling_mode, multilabel_scheme = args.multilabel_scheme,
+            mode=args.bands, packed_dir=args.packed_dir, image_cache_mb=args.image_cache_mb, io_threads=args.io_threads, raw_pixels=args.raw_pixels,
+            prefetch_depth=args.prefetch_depth, prefetch_workers=args.prefetch_workers, tf_data=args.tf_data,
+            val_manifest=args.val_manifest, test_manifest=args.test_manifest, train_shards=args.train_shards, shuffle_buffer=args.shuffle_buffer, inner_loop=args.inner_loop, meta_gradient=args.meta_gradient, anil=args.anil, jit_compile=args.jit_compile)
 
 if __name__ == '__main__':
     args = get_args()
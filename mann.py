@@ -7,7 +7,9 @@ import os
 
 import load_data_tf as load_data
 from options import get_args
-from utils import convert_to_powerset, generate_experiment_name, precision, recall, fscore, convert_to_bin_rel
+from prefetch import episode_stream
+from tracing import count_traces, enable_trace_log, trace_summary
+from utils import generate_experiment_name, precision, recall, fscore, prepare_images
 import time
 from tensorboardX import SummaryWriter
 from pathlib import Path
@@ -61,6 +63,7 @@ class MANN(tf.keras.Model):
             self.upper_lstm = tf.keras.layers.LSTM(num_classes, return_sequences=True)
 
     def call(self, input_images, input_labels):
+        input_images = prepare_images(input_images)
         b, s, h, w, c = input_images.shape
         conv_out = tf.reshape(input_images, (-1, w, h, c))
         for block in self.blocks:
@@ -115,25 +118,52 @@ class MANN(tf.keras.Model):
         #############################
 
 
-@tf.function
-def train_step(images, labels, model, optim, eval=False):
-    with tf.GradientTape() as tape:
-        predictions = model(images, labels)
-        loss = model.loss_function(predictions, labels)
-    if not eval:
+def make_train_steps(model, optim, meta_batch_size, image_shape, pixel_dtype=tf.float32):
+    """ Train and eval steps of `model`, each traced once for episodes of meta_batch_size tasks of
+    support_size + query_size images. The model and optimizer are closed over rather than passed in, so that
+    neither they nor a Python eval flag become part of the traced signature. """
+    episode_size = model.support_size + model.query_size
+    images = tf.TensorSpec([meta_batch_size, episode_size] + list(image_shape), pixel_dtype)
+    if model.multi == 'powerset':
+        labels = tf.TensorSpec([meta_batch_size, episode_size, model.num_classes], tf.float32)
+    else:
+        labels = tf.TensorSpec([meta_batch_size, episode_size, model.num_classes, 2], tf.float32)
+    # a tf.function whose first trace creates variables is traced a second time, so the model's and optimizer's
+    # variables are created eagerly up front
+    model(tf.zeros(images.shape, images.dtype), tf.zeros(labels.shape, labels.dtype))
+    if hasattr(optim, 'build'):
+        optim.build(model.trainable_variables)
+
+    @tf.function(input_signature=[images, labels])
+    @count_traces
+    def train_step(images, labels):
+        with tf.GradientTape() as tape:
+            predictions = model(images, labels)
+            loss = model.loss_function(predictions, labels)
         gradients = tape.gradient(loss, model.trainable_variables)
         optim.apply_gradients(zip(gradients, model.trainable_variables))
-    return predictions, loss
+        return predictions, loss
+
+    @tf.function(input_signature=[images, labels])
+    @count_traces
+    def eval_step(images, labels):
+        predictions = model(images, labels)
+        return predictions, model.loss_function(predictions, labels)
+    return train_step, eval_step
 
 
-def main(data_root='../cs330-storage/', num_classes=3, support_size=16, query_size=4, meta_batch_size=16, random_seed=42, iterations=1000, experiment_name=None, lr=1e-3, lr_schedule=False, sampling_mode='greedy', multi = 'powerset', log_frequency=50):
+def main(data_root='../cs330-storage/', num_classes=3, support_size=16, query_size=4, meta_batch_size=16, random_seed=42, iterations=1000, experiment_name=None, lr=1e-3, lr_schedule=False, sampling_mode='greedy', multi = 'powerset', log_frequency=50, mode='rgb', packed_dir=None, image_cache_mb=0, io_threads=None, raw_pixels=False, prefetch_depth=0, prefetch_workers=1, tf_data=False, val_manifest=None, val_split='test', train_shards=None, shuffle_buffer=256):
     random.seed(random_seed)
     np.random.seed(random_seed)
     tf.random.set_seed(random_seed)
 
     filter_files = [os.path.join(data_root, 'patches_with_cloud_and_shadow.csv'), os.path.join(data_root, 'patches_with_seasonal_snow.csv')]  # replace with your path
     data_dir = os.path.join(data_root, "SmallEarthNet")
-    meta_dataset = load_data.MetaBigEarthNetTaskDataset(data_dir=data_dir, filter_files=filter_files, support_size=support_size + query_size, label_subset_size=num_classes, split_save_path="smallearthnet.pkl", split_file="smallearthnet.pkl", data_format='channels_last')
+    meta_dataset = load_data.MetaBigEarthNetTaskDataset(data_dir=data_dir, filter_files=filter_files, support_size=support_size + query_size, label_subset_size=num_classes, data_format='channels_last', mode=mode, packed_dir=packed_dir, image_cache_bytes=image_cache_mb * 2**20, sampling_seed=random_seed, io_threads=io_threads, raw_pixels=raw_pixels)
+    val_sampling_mode = sampling_mode
+    if val_manifest:
+        meta_dataset.load_episode_manifest(val_manifest, split=val_split)
+        val_sampling_mode = 'manifest'
 
     experiment_fullname = generate_experiment_name(experiment_name, extra_tokens=[Path(__file__).stem])
     log_dir = '../tensorboard_logs/' + experiment_fullname
@@ -153,17 +183,18 @@ def main(data_root='../cs330-storage/', num_classes=3, support_size=16, query_si
     #optim = tf.keras.optimizers.Adam(learning_rate=0.00001)
     #optim = tf.keras.optimizers.SGD(learning_rate=lr_config)
     optim = tf.keras.optimizers.RMSprop(learning_rate=1e-4, rho=0.95, momentum=0.9)
+    train_step, eval_step = make_train_steps(o, optim, meta_batch_size, meta_dataset.dataset.get_shape(), pixel_dtype=tf.as_dtype(meta_dataset.dataset.pixel_dtype))
     test_accuracy = []
+    train_episodes = episode_stream(meta_dataset, batch_size=meta_batch_size, split='train', mode=sampling_mode, multi=multi, depth=prefetch_depth, num_workers=prefetch_workers, tf_data=tf_data, shard_dir=train_shards, shuffle_buffer=shuffle_buffer)
+    val_episodes = episode_stream(meta_dataset, batch_size=meta_batch_size, split=val_split, mode=val_sampling_mode, multi=multi, depth=prefetch_depth, num_workers=prefetch_workers, tf_data=tf_data)
     for step in range(iterations):
         start = time.time()
-        X, y, y_debug = meta_dataset.sample_batch(batch_size=meta_batch_size, split='train', mode=sampling_mode)
-        y = convert_to_powerset(y) if multi == 'powerset' else convert_to_bin_rel(y)
+        X, y, y_debug = next(train_episodes)
         #print(y.shape)
-        _, ls = train_step(X, y, o, optim)
+        _, ls = train_step(X, y)
 
-        X, y, y_debug = meta_dataset.sample_batch(batch_size=meta_batch_size, split='validation', mode=sampling_mode)
-        raw_y = convert_to_powerset(y) if multi == 'powerset' else convert_to_bin_rel(y)
-        raw_pred, tls = train_step(X, raw_y, o, optim, eval=True)
+        X, raw_y, y_debug = next(val_episodes)
+        raw_pred, tls = eval_step(X, raw_y)
 
         pred_tr = tf.math.argmax(raw_pred[:, :support_size, :], axis=-1)
         y_tr = tf.math.argmax(raw_y[:, :support_size, :], axis=-1)
@@ -192,6 +223,10 @@ def main(data_root='../cs330-storage/', num_classes=3, support_size=16, query_si
         
         if (step + 1) % args.log_frequency == 0:
             print("Iteration {}/{} -- Train Loss/Prec/Rec/F1: {:.4f}/{:.4f}/{:.4f}/{:.4f}".format(step + 1, iterations, ls.numpy(), prec_tr.numpy(), rec_tr.numpy(), f1_tr.numpy()), "Test Loss/Prec/Rec/F1: {:.4f}/{:.4f}/{:.4f}/{:.4f}".format(tls.numpy(), prec_ts, rec_ts, f1_ts), "Time: {:.4f}s".format(time.time() - start))
+            if meta_dataset.dataset.image_cache is not None:
+                print("Image cache:", meta_dataset.dataset.image_cache)
+            if sampling_mode == 'greedy':
+                print("Greedy sampling rejection rates:", {split: round(stats['rejection_rate'], 4) for split, stats in meta_dataset.rejection_stats().items()})
         writer.add_scalar("Train loss", ls.numpy(), step)
         writer.add_scalar("Test loss", tls.numpy(), step)
         writer.add_scalar("Test accuracy", test_acc, step)
@@ -202,10 +237,15 @@ def main(data_root='../cs330-storage/', num_classes=3, support_size=16, query_si
         writer.add_scalar("Test precision", prec_ts.numpy(), step)
         writer.add_scalar("Test recall", rec_ts.numpy(), step)
         writer.add_scalar("Test F1", f1_ts.numpy(), step)
+    train_episodes.close()
+    val_episodes.close()
+    print("Traced graphs:", trace_summary())
     return test_accuracy
 
 if __name__ == '__main__':
     args = get_args()
-    main(data_root=args.data_root, iterations=args.iterations, support_size=args.support_size, num_classes=args.label_subset_size, experiment_name=args.experiment_name, meta_batch_size=args.bs, sampling_mode=args.sampling_mode, multi = args.multilabel_scheme, log_frequency=args.log_frequency)
+    if args.trace_log:
+        enable_trace_log()
+    main(data_root=args.data_root, iterations=args.iterations, support_size=args.support_size, num_classes=args.label_subset_size, experiment_name=args.experiment_name, meta_batch_size=args.bs, sampling_mode=args.sampling_mode, multi = args.multilabel_scheme, log_frequency=args.log_frequency, mode=args.bands, packed_dir=args.packed_dir, image_cache_mb=args.image_cache_mb, io_threads=args.io_threads, raw_pixels=args.raw_pixels, prefetch_depth=args.prefetch_depth, prefetch_workers=args.prefetch_workers, tf_data=args.tf_data, val_manifest=args.val_manifest, val_split=args.val_split, train_shards=args.train_shards, shuffle_buffer=args.shuffle_buffer)
 
 
@@ -10,6 +10,23 @@ def conv_block(inp, cweight, bweight, bn, activation=tf.nn.relu, residual=False)
     normed = activation(normed)
     return normed
 
+def grouped_conv_block(inp, cweight, bweight, bn, activation=tf.nn.relu):
+    """ conv_block for every task of a meta-batch in one op.
+
+    The tasks sit side by side along the channel axis of inp, (N, W, H, tasks * C_in), and cweight, bweight carry a
+    leading task axis; the convolution runs as a single grouped conv2d with one group per task.
+    """
+    k1, k2, c_in, c_out = cweight.shape[1:]
+    # (tasks, k, k, C_in, C_out) -> (k, k, C_in, tasks * C_out): group t produces output channels [t * C_out, (t+1) * C_out)
+    filters = tf.reshape(tf.transpose(cweight, [1, 2, 3, 0, 4]), [k1, k2, c_in, -1])
+    conv_output = tf.nn.conv2d(input=inp, filters=filters, strides=[1, 1, 1, 1], padding='SAME') + tf.reshape(bweight, [-1])
+    # batch norm runs on its moving statistics, i.e. the same per-channel affine map for every task, so all tasks
+    # are normalized at once with the task axis folded into the spatial ones
+    shape = tf.shape(conv_output)
+    normed = bn(tf.reshape(conv_output, [shape[0], shape[1], -1, c_out]))
+    normed = activation(normed)
+    return tf.reshape(normed, shape)
+
 class VGGWrapper(tf.keras.layers.Layer):
     def __init__(self, channels, dim_hidden, dim_output, img_size):
         super(VGGWrapper, self).__init__()
@@ -62,6 +79,9 @@ class VanillaConvModel(tf.keras.layers.Layer):
         weights['conv4'] = tf.Variable(weight_initializer([k, k, self.dim_hidden, self.dim_hidden]), name='conv4', dtype=dtype)
         weights['b4'] = tf.Variable(tf.zeros([self.dim_hidden]), name='b4')
         self.bn4 = tf.keras.layers.BatchNormalization(name='bn4')
+        # built up front, so that the first forward pass does not have to be run just to create their variables
+        for bn in [self.bn1, self.bn2, self.bn3, self.bn4]:
+            bn.build((None, None, None, self.dim_hidden))
 
         if self.multi == 'binary':
             for i in range(self.dim_output):
@@ -73,8 +93,10 @@ class VanillaConvModel(tf.keras.layers.Layer):
             weights['b5'] = tf.Variable(tf.zeros([self.dim_output]), name='b5')
 
         self.model_weights = weights
+        # the weights of the output layer, the only ones adapted by ANIL
+        self.head_keys = [key for key in weights if key.startswith(('w5', 'b5', 'brw', 'brb'))]
 
-    def call(self, inp, weights):
+    def backbone(self, inp, weights):
         channels = self.channels
         #inp = tf.transpose(inp, perm=[0, 2, 3, 1])
         #inp = tf.reshape(inp, [-1, self.img_size, self.img_size, channels])
@@ -82,18 +104,29 @@ class VanillaConvModel(tf.keras.layers.Layer):
         hidden2 = conv_block(hidden1, weights['conv2'], weights['b2'], self.bn2)
         hidden3 = conv_block(hidden2, weights['conv3'], weights['b3'], self.bn3)
         hidden4 = conv_block(hidden3, weights['conv4'], weights['b4'], self.bn4)
-        hidden4 = tf.reduce_mean(input_tensor=hidden4, axis=[1, 2])
-        
+        return tf.reduce_mean(input_tensor=hidden4, axis=[1, 2])
 
+    def head(self, hidden4, weights):
+        # (N, dim_hidden) features with unbatched weights, or (tasks, N, dim_hidden) with a leading task axis on both
         if self.multi == 'binary':
-
-            output = tf.expand_dims(tf.matmul(hidden4, weights['brw0']) + weights['brb0'], axis = 1)
-            for i in range(1, self.dim_output):
-                output = tf.concat([output, tf.expand_dims(tf.matmul(hidden4, weights['brw' + str(i)]) + weights['brb' + str(i)], axis = 1)], axis = 1)
-
-            return output
-
+            return tf.stack([tf.matmul(hidden4, weights['brw' + str(i)]) + tf.expand_dims(weights['brb' + str(i)], -2) for i in range(self.dim_output)], axis=-2)
         else:
-            return tf.matmul(hidden4, weights['w5']) + weights['b5']
-
+            return tf.matmul(hidden4, weights['w5']) + tf.expand_dims(weights['b5'], -2)
 
+    def call(self, inp, weights):
+        return self.head(self.backbone(inp, weights), weights)
+
+    def backbone_batched(self, inp, weights):
+        """ backbone for a whole meta-batch: inp is (tasks, N, W, H, C) and every weight has a leading task axis. """
+        shape = tf.shape(inp)
+        # tasks go side by side along the channel axis, see grouped_conv_block
+        hidden = tf.reshape(tf.transpose(inp, [1, 2, 3, 0, 4]), [shape[1], shape[2], shape[3], -1])
+        hidden = grouped_conv_block(hidden, weights['conv1'], weights['b1'], self.bn1)
+        hidden = grouped_conv_block(hidden, weights['conv2'], weights['b2'], self.bn2)
+        hidden = grouped_conv_block(hidden, weights['conv3'], weights['b3'], self.bn3)
+        hidden = grouped_conv_block(hidden, weights['conv4'], weights['b4'], self.bn4)
+        hidden4 = tf.reduce_mean(input_tensor=hidden, axis=[1, 2])
+        return tf.transpose(tf.reshape(hidden4, [shape[1], shape[0], self.dim_hidden]), [1, 0, 2]) # (tasks, N, dim_hidden)
+
+    def call_batched(self, inp, weights):
+        return self.head(self.backbone_batched(inp, weights), weights)
@@ -7,6 +7,11 @@ def get_args():
     psr.add_argument("--num_inner_updates", type=int, default=1, help="Number of inner optimization steps (MAML).")
     psr.add_argument("--iterations", type=int, default=4000, help="Number of outer optimization iterations (MAML).")
     psr.add_argument("--lr", type=float, default=1e-3, help="Learning rate (outer, if applicable)")
+    psr.add_argument("--inner-loop", choices=['vectorized', 'map_fn'], default='vectorized', help="Adapt all tasks of a meta-batch at once with stacked fast weights and grouped convolutions, or one task at a time with tf.map_fn (MAML)")
+    psr.add_argument("--meta-gradient", choices=['maml', 'fomaml', 'reptile'], default='maml', help="Outer gradient: exact second-order MAML, its first-order approximation, or Reptile's (initial - adapted weights) direction; the first-order variants do not keep inner-loop graphs alive (MAML)")
+    psr.add_argument("--anil", action='store_true', help="Adapt only the output layer in the inner loop, on backbone features computed once per task (ANIL; MAML)")
+    psr.add_argument("--jit-compile", action='store_true', help="Compile the whole outer train and eval steps with XLA (requires --inner-loop vectorized; MAML). On CPU, XLA backpropagates through grouped convolutions slowly, so combine it with --anil there")
+    psr.add_argument("--trace-log", action='store_true', help="Log every trace of a tf.function with its input shapes; retraces of an already traced signature are always logged as warnings")
     psr.add_argument("--learn-inner-lr", action='store_true', help="Whether to dynamically update the inner MAML learning rate.")
     psr.add_argument("--bs", "--batch-size", type=int, default=8, help="Meta-batch size (# of size-N disjoint label subsets.")
     psr.add_argument("--label-subset-size", type=int, default=3, help="Maximum cardinality of multi-labels in each meta-example (task).")
@@ -15,10 +20,23 @@ def get_args():
     psr.add_argument("--log-frequency", type=int, default=5, help="How often to print meta-train/val results")
     psr.add_argument("--test-log-frequency", type=int, default=25, help="How often to print meta-test results")
     psr.add_argument("--data-root", type=str, default="../cs330-storage", help="Path to all data")
+    psr.add_argument("--bands", choices=['rgb', 'all'], default='rgb', help="Spectral bands to use: RGB only, or all 12 bands resampled to 120x120")
+    psr.add_argument("--packed-dir", type=str, default=None, help="Path to a packed patch store built by pack_data.py (default: read GeoTIFFs directly)")
+    psr.add_argument("--image-cache-mb", type=int, default=0, help="Byte budget (MB) of the in-memory LRU cache of decoded images (0 disables it)")
+    psr.add_argument("--io-threads", type=int, default=None, help="Threads reading GeoTIFF bands concurrently (default: number of cores + 4)")
+    psr.add_argument("--raw-pixels", action='store_true', help="Keep pixels as uint16 up to the model and normalize them in-graph (4x less host memory and copy volume)")
+    psr.add_argument("--prefetch-depth", type=int, default=0, help="Number of meta-batches sampled ahead of the trainer in background threads (0 samples synchronously)")
+    psr.add_argument("--prefetch-workers", type=int, default=1, help="Number of background sampling threads per split when --prefetch-depth > 0")
+    psr.add_argument("--tf-data", action='store_true', help="Feed episodes through the tf.data pipeline (parallel decode, in-graph normalization) instead of sample_batch")
+    psr.add_argument("--val-manifest", type=str, default=None, help="Episode manifest (make_episode_manifest.py) to replay for meta-validation instead of sampling; it must be drawn from the meta-validation split, val for MAML and --val-split for MANN")
+    psr.add_argument("--val-split", choices=['val', 'test'], default='test', help="Split to meta-validate on; pass val to share a --val-manifest with MAML (MANN)")
+    psr.add_argument("--train-shards", type=str, default=None, help="Directory of pre-rendered episode shards (make_episode_shards.py) to stream for meta-training instead of sampling")
+    psr.add_argument("--shuffle-buffer", type=int, default=256, help="Number of episodes in the shuffle buffer when streaming --train-shards")
+    psr.add_argument("--test-manifest", type=str, default=None, help="Episode manifest (make_episode_manifest.py) to replay for meta-testing instead of sampling")
     psr.add_argument("--experiment-name", type=str, default=None, help="Name of experiment (logging)")
     psr.add_argument("--test", action='store_true')
     psr.add_argument("--model-class-name", type=str, default="VanillaConvModel", help="Model class name (in models.py)")
-    psr.add_argument("--sampling-mode", type=str, choices=['permutation', 'greedy'], default='greedy', help="Multi-label task sampling framework")
+    psr.add_argument("--sampling-mode", type=str, choices=['permutation', 'greedy', 'balanced'], default='greedy', help="Multi-label task sampling framework")
     psr.add_argument("--embed-dim", type=int, default=16, help="Embedding dimension for protonets")
     psr.add_argument("--num-conv-filters", type=int, default=64, help="Number of filters in convolutional blocks (Protonets)")
     psr.add_argument("--patience", type=int, default=200, help="Number of validation loss iterations without improvement before stopping")
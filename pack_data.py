@@ -0,0 +1,19 @@
+import os
+from argparse import ArgumentParser
+
+from load_data_tf import BigEarthNetDataset
+from patch_store import pack_dataset
+
+if __name__ == '__main__':
+    psr = ArgumentParser()
+    psr.add_argument("--data-root", type=str, default="../cs330-storage", help="Path to all data")
+    psr.add_argument("--data-subdir", type=str, default="SmallEarthNet", help="Directory of patches, relative to --data-root")
+    psr.add_argument("--output-dir", type=str, default=None, help="Where to write the packed store (default: <data-root>/<data-subdir>_packed)")
+    psr.add_argument("--mode", choices=['rgb', 'all'], default='rgb', help="Which spectral bands to pack")
+    args = psr.parse_args()
+
+    filter_files = [os.path.join(args.data_root, 'patches_with_cloud_and_shadow.csv'), os.path.join(args.data_root, 'patches_with_seasonal_snow.csv')]
+    output_dir = args.output_dir or os.path.join(args.data_root, args.data_subdir + "_packed")
+    dataset = BigEarthNetDataset(os.path.join(args.data_root, args.data_subdir), filter_files=filter_files, mode=args.mode, warn_resampling=False)
+    print("Packing {} patches into {}".format(len(dataset), output_dir))
+    pack_dataset(dataset, output_dir)
@@ -0,0 +1,111 @@
+import os
+import csv
+import json
+import hashlib
+
+import numpy as np
+
+# Bump whenever the on-disk layout below changes.
+PATCH_MANIFEST_VERSION = 2
+
+
+def _file_stamp(path):
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime_ns]
+
+
+def read_filter_files(filter_files):
+    eliminated = set()
+    for file_path in filter_files:
+        with open(file_path, 'r') as f:
+            for row in csv.reader(f, delimiter=','):
+                eliminated.add(row[0])
+    return eliminated
+
+
+def listing_key(patches):
+    # hash of a patch listing, in the order given
+    return hashlib.sha1("\n".join(patches).encode()).hexdigest()[:16]
+
+
+class PatchList():
+    """ Read-only sequence of the patch names kept by a manifest, decoded one at a time from the mapped names array.
+
+    `key` is the listing_key of the names, as stored in the manifest, so caches keyed on the listing need not re-hash it.
+    """
+
+    def __init__(self, names, index, key):
+        self.names = names  # (N,) bytes, usually memory-mapped
+        self.index = index  # (n,) positions of the kept names
+        self.key = key
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return np.asarray(self.names[self.index[i]]).astype(str).tolist()
+        return self.names[self.index[i]].decode()
+
+    def __iter__(self):
+        for i in range(len(self.index)):
+            yield self.names[self.index[i]].decode()
+
+    def __array__(self, dtype=None, copy=None):
+        # vectorized decode, e.g. for np.array(patches) when a cache or store is written
+        names = np.asarray(self.names[self.index]).astype(str)
+        return names if dtype is None else names.astype(dtype)
+
+
+class PatchManifest():
+    """ Sorted patch listing of a data directory and the mask of patches that survive the filter CSVs.
+
+    Persisted as .npy files next to a json stamp of the directory and filter file mtimes, so a process start
+    costs one stat per file instead of listing hundreds of thousands of patch directories.
+    """
+
+    def __init__(self, names, mask, key):
+        self.names = names  # (N,) bytes
+        self.mask = mask  # (N,) bool
+        self.key = key  # listing_key of the kept names
+        self.patches = PatchList(names, np.flatnonzero(mask), key)
+
+    @staticmethod
+    def cache_prefix(data_dir, cache_dir='.'):
+        key = hashlib.sha1(os.path.abspath(data_dir).encode()).hexdigest()[:16]
+        return os.path.join(cache_dir, "patches_{}".format(key))
+
+    @classmethod
+    def load(cls, data_dir, filter_files=(), cache_dir='.'):
+        prefix = cls.cache_prefix(data_dir, cache_dir)
+        dir_stamp = os.stat(data_dir).st_mtime_ns
+        filter_stamps = [[os.path.abspath(path)] + _file_stamp(path) for path in filter_files]
+        meta = None
+        if os.path.isfile(prefix + '.json'):
+            with open(prefix + '.json', 'r') as f:
+                meta = json.load(f)
+        if meta is not None and meta['version'] == PATCH_MANIFEST_VERSION and meta['dir_mtime_ns'] == dir_stamp:
+            names = np.load(prefix + '.names.npy', mmap_mode='r')
+            if meta['filters'] == filter_stamps:
+                return cls(names, np.load(prefix + '.mask.npy', mmap_mode='r'), meta['listing_key'])
+            # same listing, different filters: only the mask needs rebuilding
+            names = np.array(names)
+        else:
+            print("Patch manifest at {} is missing or stale; listing {}.".format(prefix + '.json', data_dir))
+            names = np.array(sorted(name.encode() for name in os.listdir(data_dir)), dtype=bytes)
+        eliminated = {name.encode() for name in read_filter_files(filter_files)}
+        mask = np.fromiter((name not in eliminated for name in names), dtype=bool, count=len(names))
+        manifest = cls(names, mask, hashlib.sha1(b"\n".join(names[mask])).hexdigest()[:16])
+        manifest.save(prefix, data_dir, dir_stamp, filter_stamps)
+        return manifest
+
+    def save(self, prefix, data_dir, dir_stamp, filter_stamps):
+        os.makedirs(os.path.dirname(prefix) or '.', exist_ok=True)
+        for suffix, array in [('.names.npy', self.names), ('.mask.npy', self.mask)]:
+            np.save(prefix + suffix + '.tmp.npy', array)
+            os.replace(prefix + suffix + '.tmp.npy', prefix + suffix)
+        # the stamp is written last so that an interrupted write is never picked up as a valid manifest
+        with open(prefix + '.json.tmp', 'w') as f:
+            json.dump({'version': PATCH_MANIFEST_VERSION, 'data_dir': os.path.abspath(data_dir), 'dir_mtime_ns': dir_stamp,
+                       'filters': filter_stamps, 'num_patches': len(self.names), 'listing_key': self.key}, f)
+        os.replace(prefix + '.json.tmp', prefix + '.json')
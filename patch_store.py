@@ -0,0 +1,83 @@
+import os
+import json
+
+import numpy as np
+from tqdm import tqdm
+
+# Bump whenever the on-disk layout below changes.
+STORE_VERSION = 1
+PATCH_SIZE = 120
+
+_IMAGES_FILE = 'images.npy'
+_LABELS_FILE = 'labels.npy'
+_PATCHES_FILE = 'patches.npy'
+_META_FILE = 'meta.json'
+
+
+def label_vector_to_bits(labels):
+    bits = 0
+    for i in np.where(labels)[0]:
+        bits |= 1 << int(i)
+    return bits
+
+
+def pack_dataset(dataset, out_dir, chunk_size=256):
+    """ Pack every patch of a BigEarthNetDataset into a uint16 (N, 120, 120, C) memmap + uint64 label bitmasks.
+
+    Every band is resampled to 120x120 on the way in, so 'all' mode stores carry all 12 bands at the 10m resolution.
+    """
+    n_labels = len(dataset.counts)
+    if n_labels > 64:
+        raise Exception("Label bitmasks only support up to 64 classes, but found {}.".format(n_labels))
+    os.makedirs(out_dir, exist_ok=True)
+    n = len(dataset)
+    images = np.lib.format.open_memmap(os.path.join(out_dir, _IMAGES_FILE), mode='w+', dtype=np.uint16, shape=(n, PATCH_SIZE, PATCH_SIZE, len(dataset.bands)))
+    labels = np.lib.format.open_memmap(os.path.join(out_dir, _LABELS_FILE), mode='w+', dtype=np.uint64, shape=(n,))
+    for start in tqdm(range(0, n, chunk_size)):
+        ids = list(range(start, min(start + chunk_size, n)))
+        images[start:start + len(ids)] = np.stack(dataset.read_raw_many(ids))
+        for i in ids:
+            labels[i] = label_vector_to_bits(dataset.read_labels(i))
+    images.flush()
+    labels.flush()
+    del images, labels
+    np.save(os.path.join(out_dir, _PATCHES_FILE), np.array(dataset.patches))
+    # metadata is written last so that an interrupted conversion is never picked up as a valid store
+    with open(os.path.join(out_dir, _META_FILE), 'w') as f:
+        json.dump({'version': STORE_VERSION, 'bands': dataset.bands, 'label_names': list(dataset.counts.keys()), 'num_patches': n}, f)
+
+
+class PackedPatchStore():
+    def __init__(self, store_dir):
+        meta_path = os.path.join(store_dir, _META_FILE)
+        if not os.path.isfile(meta_path):
+            raise Exception("No packed patch store found at {}; build one with `python pack_data.py`.".format(store_dir))
+        with open(meta_path, 'r') as f:
+            meta = json.load(f)
+        if meta['version'] != STORE_VERSION:
+            raise Exception("Packed patch store at {} has version {} but version {} is required; please rebuild it.".format(store_dir, meta['version'], STORE_VERSION))
+        self.store_dir = store_dir
+        self.bands = meta['bands']
+        self.label_names = meta['label_names']
+        self.images = np.load(os.path.join(store_dir, _IMAGES_FILE), mmap_mode='r')
+        self.labels = np.load(os.path.join(store_dir, _LABELS_FILE), mmap_mode='r')
+        self.patches = np.load(os.path.join(store_dir, _PATCHES_FILE))
+
+    def check_compatible(self, patches, bands, label_names):
+        if list(bands) != list(self.bands):
+            raise Exception("Packed patch store at {} holds bands {}, but the dataset uses {}.".format(self.store_dir, self.bands, bands))
+        if list(label_names) != list(self.label_names):
+            raise Exception("Packed patch store at {} was built with a different label ordering; please rebuild it.".format(self.store_dir))
+        if len(patches) != len(self.patches) or not np.array_equal(self.patches, np.array(patches)):
+            raise Exception("Packed patch store at {} does not match the filtered patch list; please rebuild it.".format(self.store_dir))
+
+    def label_vector(self, idx):
+        bits = int(self.labels[idx])
+        return np.array([(bits >> i) & 1 for i in range(len(self.label_names))])
+
+    def __getitem__(self, idx):
+        # zero-copy view into the memmap, shape (W, H, C)
+        return self.images[idx]
+
+    def __len__(self):
+        return len(self.images)
@@ -0,0 +1,142 @@
+import queue
+import threading
+
+from episode_shards import EpisodeShardReader
+from utils import convert_to_powerset, convert_to_bin_rel, support_query_split
+
+
+def make_episode_transform(multi='powerset', split_support_query=False):
+    # label conversion (and optionally the support/query split) applied to every sampled batch
+    converter = convert_to_powerset if multi == 'powerset' else convert_to_bin_rel
+
+    def transform(X, y, y_debug):
+        if split_support_query:
+            return support_query_split(X, y, converter, support_dim=1)
+        return X, converter(y), y_debug
+    return transform
+
+
+class _WorkerError():
+    def __init__(self, exc):
+        self.exc = exc
+
+
+class EpisodePrefetcher():
+    """ Iterator over meta_dataset.sample_batch(...) batches, produced ahead of time by background threads into a bounded queue. """
+
+    def __init__(self, meta_dataset, batch_size=8, split='train', mode='greedy', transform=None, depth=2, num_workers=1):
+        self.meta_dataset = meta_dataset
+        self.batch_size = batch_size
+        self.split = split
+        self.mode = mode
+        self.transform = transform
+        self.depth = depth
+        # batches are assembled in preallocated buffers; enough of them for every batch that can be alive at once
+        # (queued, being sampled by a worker, and the one held by the consumer). The consumer's buffer goes back to
+        # the free list when it asks for the next batch
+        self._ring = meta_dataset.batch_ring(batch_size, size=depth + num_workers + 1 if depth > 0 else 1)
+        self._held = None
+        # depth == 0 falls back to sampling synchronously in __next__
+        self._queue = queue.Queue(maxsize=depth) if depth > 0 else None
+        self._stop = threading.Event()
+        self._workers = []
+        if depth > 0:
+            for i in range(num_workers):
+                worker = threading.Thread(target=self._work, name="episode-prefetch-{}-{}".format(split, i), daemon=True)
+                worker.start()
+                self._workers.append(worker)
+
+    def _sample(self, slot, out):
+        try:
+            batch = self.meta_dataset.sample_batch(batch_size=self.batch_size, split=self.split, mode=self.mode, out=out)
+            if self.transform is not None:
+                batch = self.transform(*batch)
+        except Exception:
+            self._ring.release(slot)
+            raise
+        return slot, batch
+
+    def _work(self):
+        while not self._stop.is_set():
+            acquired = self._ring.acquire(timeout=0.1)
+            if acquired is None:
+                continue
+            try:
+                item = self._sample(*acquired)
+            except Exception as e:
+                item = _WorkerError(e)
+            while not self._stop.is_set():
+                try:
+                    self._queue.put(item, timeout=0.1)
+                    break
+                except queue.Full:
+                    continue
+            if isinstance(item, _WorkerError):
+                return
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._held is not None:
+            self._ring.release(self._held)
+            self._held = None
+        if self._queue is None:
+            self._held, batch = self._sample(*self._ring.acquire())
+            return batch
+        item = self._queue.get()
+        if isinstance(item, _WorkerError):
+            self.close()
+            raise item.exc
+        self._held, batch = item
+        return batch
+
+    def close(self):
+        self._stop.set()
+        if self._queue is not None:
+            # unblock workers waiting on a full queue
+            while True:
+                try:
+                    self._queue.get_nowait()
+                except queue.Empty:
+                    break
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class TFDataEpisodes():
+    """ Iterator over a MetaBigEarthNetTaskDataset.as_tf_dataset pipeline, interchangeable with EpisodePrefetcher. """
+
+    def __init__(self, meta_dataset, batch_size=8, split='train', mode='greedy', multi='powerset', split_support_query=False):
+        self.dataset = meta_dataset.as_tf_dataset(batch_size=batch_size, split=split, mode=mode, multi=multi, split_support_query=split_support_query)
+        self._iterator = iter(self.dataset)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._iterator)
+
+    def close(self):
+        self._iterator = None
+
+
+def episode_stream(meta_dataset, batch_size=8, split='train', mode='greedy', multi='powerset', split_support_query=False, depth=0, num_workers=1, tf_data=False, shard_dir=None, shuffle_buffer=256):
+    # shard_dir streams pre-rendered episodes (see episode_shards.py) instead of sampling them from the dataset
+    if shard_dir is not None:
+        if tf_data:
+            raise Exception("Episode shards are read by an EpisodePrefetcher and cannot be combined with tf_data.")
+        source = EpisodeShardReader(shard_dir, meta_dataset, split=split, shuffle_buffer=shuffle_buffer)
+        transform = make_episode_transform(multi, split_support_query=split_support_query)
+        return EpisodePrefetcher(source, batch_size=batch_size, split=split, mode=mode, transform=transform, depth=depth, num_workers=num_workers)
+    if tf_data:
+        return TFDataEpisodes(meta_dataset, batch_size=batch_size, split=split, mode=mode, multi=multi, split_support_query=split_support_query)
+    transform = make_episode_transform(multi, split_support_query=split_support_query)
+    return EpisodePrefetcher(meta_dataset, batch_size=batch_size, split=split, mode=mode, transform=transform, depth=depth, num_workers=num_workers)
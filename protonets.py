@@ -12,6 +12,7 @@ from utils import *
 from tensorboardX import SummaryWriter
 
 from mann import SNAILConvBlock
+from prefetch import episode_stream
 import time
 
 class ProtoNet(tf.keras.Model):
@@ -43,7 +44,7 @@ class ProtoNet(tf.keras.Model):
             self.embed = [SNAILConvBlock(num_filters) for _ in range(num_classes)]
 
     def call(self, inp):
-        out = inp
+        out = prepare_images(inp)
         for conv in self.convs:
             out = conv(out)
         if self.multi == 'powerset':
@@ -151,7 +152,7 @@ def proto_net_eval(model, x, q, labels_ph, label_subset_size):
     return ce_loss, prec, rec, f1
 
 
-def run_protonet(data_root='../cs330-storage', n_way=3, n_support=8, n_query=8, n_meta_test_way=3, n_meta_test_support=8, n_meta_test_query=8, multi='powerset', experiment_name=None, n_episodes=10000, latent_dim=16, lr=1e-3, num_filters=64, log_frequency=5, patience=200):
+def run_protonet(data_root='../cs330-storage', n_way=3, n_support=8, n_query=8, n_meta_test_way=3, n_meta_test_support=8, n_meta_test_query=8, multi='powerset', experiment_name=None, n_episodes=10000, latent_dim=16, lr=1e-3, num_filters=64, log_frequency=5, patience=200, mode='rgb', packed_dir=None, image_cache_mb=0, io_threads=None, raw_pixels=False, prefetch_depth=0, prefetch_workers=1, tf_data=False, val_manifest=None, test_manifest=None, train_shards=None, shuffle_buffer=256):
 
     n_meta_test_episodes = 1000
     experiment_fullname = generate_experiment_name(experiment_name, extra_tokens=[Path(__file__).stem])
@@ -175,14 +176,22 @@ def run_protonet(data_root='../cs330-storage', n_way=3, n_support=8, n_query=8,
 
     filter_files = [os.path.join(data_root, 'patches_with_cloud_and_shadow.csv'), os.path.join(data_root, 'patches_with_seasonal_snow.csv')]  # replace with your path
     data_dir = os.path.join(data_root, "SmallEarthNet")
-    meta_dataset = load_data.MetaBigEarthNetTaskDataset(data_dir=data_dir, support_size=n_support+n_query, label_subset_size=n_way, filter_files=filter_files, split_save_path="smallearthnet.pkl", split_file="smallearthnet.pkl", data_format='channels_last')
-
+    meta_dataset = load_data.MetaBigEarthNetTaskDataset(data_dir=data_dir, support_size=n_support+n_query, label_subset_size=n_way, filter_files=filter_files, data_format='channels_last', mode=mode, packed_dir=packed_dir, image_cache_bytes=image_cache_mb * 2**20, io_threads=io_threads, raw_pixels=raw_pixels)
+    val_sampling_mode, test_sampling_mode = 'permutation', 'permutation'
+    if val_manifest:
+        meta_dataset.load_episode_manifest(val_manifest, split='val')
+        val_sampling_mode = 'manifest'
+    if test_manifest:
+        n_meta_test_episodes = meta_dataset.load_episode_manifest(test_manifest, split='test')
+        test_sampling_mode = 'manifest'
+
+    train_episodes = episode_stream(meta_dataset, batch_size=1, split='train', mode='permutation', multi=multi, depth=prefetch_depth, num_workers=prefetch_workers, tf_data=tf_data, shard_dir=train_shards, shuffle_buffer=shuffle_buffer)
+    val_episodes = episode_stream(meta_dataset, batch_size=1, split='val', mode=val_sampling_mode, multi=multi, depth=prefetch_depth, num_workers=prefetch_workers, tf_data=tf_data)
     best_episode, best_val_loss = 0, float('inf')
     for ep in range(n_episodes):
         start = time.time()
         ls, prec, rec, f1 = [], [], [], []
-        X, y, y_debug = meta_dataset.sample_batch(batch_size=1, split='train', mode='permutation')
-        y = convert_to_powerset(y) if multi == 'powerset' else convert_to_bin_rel(y)
+        X, y, y_debug = next(train_episodes)
         # Powerset shapes: (1, support + query, h, w, c); (1, support + query, 2^n_classes - 1)
         # BR shapes: " , (1, support + query, n_classes, 2)
         _, s, h, w, c = X.shape
@@ -202,8 +211,7 @@ def run_protonet(data_root='../cs330-storage', n_way=3, n_support=8, n_query=8,
         writer.add_scalar('Meta-train precision', mean_prec, ep)
         writer.add_scalar('Meta-train recall', mean_rec, ep)
         writer.add_scalar('Meta-train F1', mean_f1, ep)
-        X, y, y_debug = meta_dataset.sample_batch(batch_size=1, split='val', mode='permutation')
-        y = convert_to_powerset(y) if multi == 'powerset' else convert_to_bin_rel(y)
+        X, y, y_debug = next(val_episodes)
 
         X = tf.squeeze(X, axis=0)
         support, query = X[:n_support, ...], X[n_support:, ...]
@@ -218,6 +226,8 @@ def run_protonet(data_root='../cs330-storage', n_way=3, n_support=8, n_query=8,
 
         if (ep + 1) % log_frequency == 0:
             print('Iteration {}/{} - meta-train loss/prec/rec/f1: {:.4f}/{:.4f}/{:.4f}/{:.4f}, meta-val loss/prec/rec/f1: {:.4f}/{:.4f}/{:.4f}/{:.4f}, took {:.4f}s'.format(ep+1, n_episodes, mean_ls, mean_prec, mean_rec, mean_f1, val_ls.numpy(), val_prec.numpy(), val_rec.numpy(), val_f1.numpy(), time.time() - start))
+            if meta_dataset.dataset.image_cache is not None:
+                print("Image cache:", meta_dataset.dataset.image_cache)
     #if (epi + 1) % 100 == 0:
     #    train_losses.append(ls.numpy())
     #    train_accs.append(ac.numpy())
@@ -231,12 +241,14 @@ def run_protonet(data_root='../cs330-storage', n_way=3, n_support=8, n_query=8,
         if best_episode + patience <= ep:
             print("Validation loss failed to improve for {} epochs. Stopping at epoch {}/{}".format(patience, ep+1, n_episodes))
             break
+    train_episodes.close()
+    val_episodes.close()
     print('Testing...')
     meta_test_loss, meta_test_prec, meta_test_rec, meta_test_f1 = [], [], [], []
+    test_episodes = episode_stream(meta_dataset, batch_size=1, split='test', mode=test_sampling_mode, multi=multi, depth=prefetch_depth, num_workers=prefetch_workers, tf_data=tf_data)
     for epi in range(n_meta_test_episodes):
-        X, y, y_debug = meta_dataset.sample_batch(batch_size=1, split='test', mode='permutation')
+        X, y, y_debug = next(test_episodes)
         X = tf.squeeze(X, axis=0)
-        y = convert_to_powerset(y) if multi == 'powerset' else convert_to_bin_rel(y)
 
         support, query = X[:n_support, ...], X[n_support:, ...]
         labels = tf.squeeze(y[:, n_meta_test_support:, :], 0)
@@ -245,6 +257,7 @@ def run_protonet(data_root='../cs330-storage', n_way=3, n_support=8, n_query=8,
         meta_test_prec.append(prec_ts)
         meta_test_rec.append(rec_ts)
         meta_test_f1.append(f1_ts)
+    test_episodes.close()
     avg_prec = np.mean(meta_test_prec)
     avg_rec = np.mean(meta_test_rec)
     avg_f1 = np.mean(meta_test_f1)
@@ -253,5 +266,5 @@ def run_protonet(data_root='../cs330-storage', n_way=3, n_support=8, n_query=8,
 from options import *
 if __name__ == '__main__':
     args = get_args()
-    results = run_protonet(args.data_root, n_way=args.label_subset_size, n_support=args.support_size, n_query=args.support_size, n_meta_test_way=args.label_subset_size, n_meta_test_support=args.support_size, n_meta_test_query=args.support_size, multi=args.multilabel_scheme, experiment_name=args.experiment_name, n_episodes=args.iterations, latent_dim=args.embed_dim, lr=args.lr, num_filters=args.num_conv_filters, log_frequency=args.log_frequency, patience=args.patience)
+    results = run_protonet(args.data_root, n_way=args.label_subset_size, n_support=args.support_size, n_query=args.support_size, n_meta_test_way=args.label_subset_size, n_meta_test_support=args.support_size, n_meta_test_query=args.support_size, multi=args.multilabel_scheme, experiment_name=args.experiment_name, n_episodes=args.iterations, latent_dim=args.embed_dim, lr=args.lr, num_filters=args.num_conv_filters, log_frequency=args.log_frequency, patience=args.patience, mode=args.bands, packed_dir=args.packed_dir, image_cache_mb=args.image_cache_mb, io_threads=args.io_threads, raw_pixels=args.raw_pixels, prefetch_depth=args.prefetch_depth, prefetch_workers=args.prefetch_workers, tf_data=args.tf_data, val_manifest=args.val_manifest, test_manifest=args.test_manifest, train_shards=args.train_shards, shuffle_buffer=args.shuffle_buffer)
 
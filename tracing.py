@@ -0,0 +1,75 @@
+import logging
+import inspect
+import functools
+from collections import Counter, defaultdict
+
+import numpy as np
+import tensorflow as tf
+
+logger = logging.getLogger(__name__)
+
+# number of traces and the argument signatures traced, per function
+_trace_counts = Counter()
+_traced_signatures = defaultdict(set)
+
+
+def _describe(value):
+    if isinstance(value, (list, tuple, dict)):
+        return str(tf.nest.map_structure(_describe, value))
+    if isinstance(value, (tf.Tensor, tf.Variable, tf.TensorSpec, np.ndarray)):
+        shape = tf.TensorShape(value.shape)
+        dims = "..." if shape.rank is None else ",".join("?" if dim is None else str(dim) for dim in shape.as_list())
+        return "{}[{}]".format(tf.as_dtype(value.dtype).name, dims)
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return repr(value)
+    # models, optimizers and the like are keyed by identity, so only their type is worth logging
+    return "<{}>".format(type(value).__name__)
+
+
+def describe_signature(args, kwargs):
+    """ Dtypes and shapes of the tensors and values of the plain Python arguments of a call, as one string. """
+    described = [_describe(arg) for arg in args] + ["{}={}".format(key, _describe(value)) for key, value in sorted(kwargs.items())]
+    return "({})".format(", ".join(described))
+
+
+def count_traces(fn):
+    """ Counts and logs every trace of a function compiled with tf.function; goes beneath the decorator:
+
+        @tf.function
+        @count_traces
+        def step(...):
+
+    The Python body of a tf.function only runs while it is being traced, so every call of the wrapper is one
+    (re)trace. A trace for a new signature, e.g. a new support or meta-batch size, is logged at INFO; tracing
+    a signature that was traced before (variables created by the first trace, a new model or optimizer object) is a
+    WARNING.
+    """
+    name = fn.__qualname__
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        signature = describe_signature(args, kwargs)
+        _trace_counts[name] += 1
+        if signature in _traced_signatures[name]:
+            logger.warning("Retracing %s (trace %d) for an already traced signature %s", name, _trace_counts[name], signature)
+        else:
+            logger.info("Tracing %s (trace %d) for %s", name, _trace_counts[name], signature)
+            _traced_signatures[name].add(signature)
+        return fn(*args, **kwargs)
+    # Keras decides which arguments (e.g. `training`) a call accepts from the signature
+    wrapper.__signature__ = inspect.signature(fn)
+    return wrapper
+
+
+def trace_counts():
+    return dict(_trace_counts)
+
+
+def trace_summary():
+    return ", ".join("{}: {}".format(name, count) for name, count in sorted(_trace_counts.items())) or "nothing traced"
+
+
+def enable_trace_log():
+    # INFO records of this module only; retraces of an already traced signature are warnings and always shown
+    logging.basicConfig()
+    logger.setLevel(logging.INFO)
@@ -3,8 +3,13 @@ from sklearn.metrics import precision_score, recall_score
 import numpy as np
 import datetime
 import pytz
+import warnings
 
-# magic numbers obtained from running `python3 calculate_mean.py`
+from band_reader import BANDS
+from channel_stats import OPTICAL_MAX_VALUE, load_channel_stats
+from tracing import count_traces
+
+# RGB fallback for when `python3 calculate_mean.py` has not written channel_stats.json
 CHANNEL_MEANS = [0.19261545, 0.24894128, 0.1618804]
 CHANNEL_STDS = [0.17641555, 0.14091561, 0.11086669]
 
@@ -13,17 +18,25 @@ def cross_entropy_loss(pred, label):
     return tf.reduce_mean(tf.nn.softmax_cross_entropy_with_logits(logits=pred, labels=tf.stop_gradient(label)))
 
 
+def task_cross_entropy_loss(pred, label):
+    # cross_entropy_loss of every task of a meta-batch stacked along axis 0, shape (tasks,)
+    loss = tf.nn.softmax_cross_entropy_with_logits(logits=pred, labels=tf.stop_gradient(label))
+    return tf.reduce_mean(tf.reshape(loss, [tf.shape(loss)[0], -1]), axis=1)
+
+
 def accuracy(labels, predictions):
     return tf.reduce_mean(tf.cast(tf.equal(labels, predictions), dtype=tf.float32))
 
 @tf.function
+@count_traces
 def lazy_onehot(labels, predictions, n_classes):
     n_classes = tf.cast(n_classes, labels.dtype)
     labels = tf.math.floormod(tf.bitwise.right_shift(tf.expand_dims(labels, 1), tf.range(n_classes)), 2)
     predictions = tf.math.floormod(tf.bitwise.right_shift(tf.expand_dims(predictions, 1), tf.range(n_classes)), 2)
     return labels, predictions
 
-@tf.function
+@tf.function(reduce_retracing=True)
+@count_traces
 def precision(labels, predictions, n_classes, multi='powerset'):
     class_prec = tf.TensorArray(dtype=tf.float32, size=0, dynamic_size=True)
     if multi == 'old_powerset':
@@ -46,7 +59,8 @@ def precision(labels, predictions, n_classes, multi='powerset'):
         raise NotImplementedError()
     return tf.reduce_mean(class_prec.stack())
 
-@tf.function
+@tf.function(reduce_retracing=True)
+@count_traces
 def recall(labels, predictions, n_classes, multi='powerset'):
     class_rec = tf.TensorArray(dtype=tf.float32, size=0, dynamic_size=True)
     if multi == 'old_powerset':
@@ -71,7 +85,8 @@ def recall(labels, predictions, n_classes, multi='powerset'):
         raise NotImplementedError()
     return tf.reduce_mean(class_rec.stack())
 
-@tf.function
+@tf.function(reduce_retracing=True)
+@count_traces
 def fscore(labels, predictions, n_classes, multi='powerset', beta=1):
     class_f = tf.TensorArray(dtype=tf.float32, size=0, dynamic_size=True)
     if multi == 'old_powerset':
@@ -103,6 +118,26 @@ def fscore(labels, predictions, n_classes, multi='powerset', beta=1):
         raise NotImplementedError()
     return tf.reduce_mean(class_f.stack())
 
+def task_precision_recall_fscore(labels, predictions, n_classes, multi='powerset', beta=1):
+    """ precision, recall and fscore of every task of a meta-batch at once, each of shape (tasks,).
+
+    labels and predictions are stacked along a leading task axis, (tasks, examples) class ids for 'powerset' and
+    (tasks, examples, classes) 0/1 decisions for 'binary'; the per-class counting matches the functions above.
+    """
+    if multi == 'powerset':
+        bits = tf.range(tf.cast(n_classes, labels.dtype))
+        labels = tf.math.floormod(tf.bitwise.right_shift(tf.expand_dims(labels, -1), bits), 2)
+        predictions = tf.math.floormod(tf.bitwise.right_shift(tf.expand_dims(predictions, -1), bits), 2)
+    elif multi != 'binary':
+        raise NotImplementedError()
+    labels, predictions = tf.cast(labels == 1, tf.float32), tf.cast(predictions == 1, tf.float32)
+    true_positives = tf.reduce_sum(labels * predictions, axis=1)
+    predicted, actual = tf.reduce_sum(predictions, axis=1), tf.reduce_sum(labels, axis=1)
+    prec = tf.math.divide_no_nan(true_positives, predicted)
+    rec = tf.math.divide_no_nan(true_positives, actual)
+    f = tf.math.divide_no_nan((1 + beta ** 2) * prec * rec, beta ** 2 * prec + rec)
+    return tf.reduce_mean(prec, axis=-1), tf.reduce_mean(rec, axis=-1), tf.reduce_mean(f, axis=-1)
+
 def convert_to_powerset(y):
     _, _, subset_size = y.shape # (batch_size, support_size, label_subset_size)
     num_classes = (1 << subset_size) - 1
@@ -110,6 +145,13 @@ def convert_to_powerset(y):
     one_hot = np.eye(num_classes)[single_labels]
     return one_hot.astype(np.float32)
 
+def convert_to_powerset_tf(y):
+    # in-graph convert_to_powerset; floormod mirrors numpy's wrap-around for all-zero label rows
+    subset_size = y.shape[-1]
+    num_classes = (1 << subset_size) - 1
+    single_labels = tf.cast(tf.reduce_sum(y * 2. ** tf.range(subset_size, dtype=y.dtype), axis=-1), tf.int32) - 1
+    return tf.one_hot(tf.math.floormod(single_labels, num_classes), num_classes)
+
 def convert_to_bin_rel(y):
     return tf.stack([1-y, y], axis = -1)
 
@@ -134,12 +176,61 @@ def generate_experiment_name(experiment_name, extra_tokens=[], timestamp=True):
     experiment_fullname = "_".join(experiment_tokens)
     return experiment_fullname
 
-def normalize(img,data_format='channels_last'):
-    if data_format == 'channels_last':
-        means = CHANNEL_MEANS
-        stds = CHANNEL_STDS
-    elif data_format == 'channels_first':
-        means = CHANNEL_MEANS[:, np.newaxis, np.newaxis]
-        stds = CHANNEL_MEANS[:, np.newaxis, np.newaxis]
-    return (img - CHANNEL_MEANS) / (CHANNEL_STDS)
-
+_warned_bands = set()
+
+_computed_stats = None
+
+def default_bands(n_channels):
+    # the band set of the 'rgb' or 'all' mode with n_channels bands, for callers that only know the image shape
+    for bands in BANDS.values():
+        if len(bands) == n_channels:
+            return bands
+    return ()
+
+def channel_stats(bands):
+    # (means, stds) for images of the given band list, or None if they have not been computed for that band set
+    global _computed_stats
+    if _computed_stats is None:
+        _computed_stats = load_channel_stats()
+    bands = tuple(bands)
+    if bands in _computed_stats:
+        entry = _computed_stats[bands]
+        return np.array(entry['means'], dtype=np.float32), np.array(entry['stds'], dtype=np.float32)
+    if bands == tuple(BANDS['rgb']):
+        return np.array(CHANNEL_MEANS, dtype=np.float32), np.array(CHANNEL_STDS, dtype=np.float32)
+    if bands not in _warned_bands:
+        _warned_bands.add(bands)
+        warnings.warn("No channel statistics for bands {}; inputs are only scaled to [0, 1]. Run `python calculate_mean.py` to compute them.".format(list(bands)))
+    return None
+
+def normalize(img,data_format='channels_last', out=None, bands=None):
+    # `out` may be `img` itself to normalize in place; bands default to the standard band set of the channel count
+    n_channels = img.shape[-1] if data_format == 'channels_last' else img.shape[0]
+    stats = channel_stats(bands if bands is not None else default_bands(n_channels))
+    if stats is None:
+        if out is None:
+            return img
+        out[...] = img
+        return out
+    means, stds = stats
+    if data_format == 'channels_first':
+        means = means[:, np.newaxis, np.newaxis]
+        stds = stds[:, np.newaxis, np.newaxis]
+    img = np.subtract(img, means, out=out)
+    return np.divide(img, stds, out=img)
+
+def normalize_raw(raw, max_value=OPTICAL_MAX_VALUE, bands=None):
+    # in-graph counterpart of BigEarthNetDataset.decode for channels_last uint16 reflectances:
+    # clip(x / max, 0, 1) followed by (x - mean) / std, folded into a single min + multiply-add
+    stats = channel_stats(bands if bands is not None else default_bands(raw.shape[-1]))
+    scale, offset = np.float32(1. / max_value), np.float32(0.)
+    if stats is not None:
+        means, stds = stats
+        scale, offset = scale / stds, means / stds
+    return tf.minimum(tf.cast(raw, tf.float32), max_value) * scale - offset
+
+def prepare_images(images):
+    # models accept either normalized float32 images or raw uint16 reflectances (BigEarthNetDataset(raw_pixels=True))
+    if images.dtype == tf.uint16:
+        return normalize_raw(images)
+    return images